@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Benchmark comparestandoffs.compare_annotations() against the nested
+# loop matching it replaced, on synthetic dense documents of
+# increasing size. Checks that both produce the same output and stats.
+
+import sys
+import os
+import io
+import random
+import timeit
+
+from argparse import Namespace
+from collections import defaultdict
+from contextlib import redirect_stdout
+from itertools import chain
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from comparestandoffs import Textbound, types_match, compare_annotations
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('-s', '--sizes', default='250,1000,4000',
+                    help='comma-separated numbers of annotations per '
+                    'document (default 250,1000,4000)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='number of timing runs (default 3)')
+    return ap
+
+
+def legacy_compare_annotations(ann1, ann2, options, stats, label):
+    # compare_annotations() before indexing (retyping, filtering and
+    # type mapping omitted), with the overlap predicate also matching
+    # a2 containing a1
+    match1, only1 = set(), set()
+    match2, only2 = set(), set()
+    for a1 in ann1:
+        if not options.overlap:
+            a2m = [
+                a2 for a2 in ann2 if
+                a1.start == a2.start and
+                a1.end == a2.end and
+                types_match(a1.type, a2.type, a1.text, a2.text, options)
+            ]
+        else:
+            a2m = [
+                a2 for a2 in ann2 if
+                a2.start <= a1.end and a2.end >= a1.start and
+                types_match(a1.type, a2.type, a1.text, a2.text, options)
+            ]
+        if a2m:
+            print('MATCH: "{}" ({}/{})'.format(a1.text, a1.type, a2m[0].type))
+            match1.add(a1)
+            match2.update(a2m)
+            stats['metrics total']['TP'] += 1
+            stats['metrics {}'.format(a1.type)]['TP'] += 1
+            for a in chain([a1], a2m):
+                stats['by type']['matched {}'.format(a.type)] += 1
+        else:
+            print('ONLY1: "{}" ({})'.format(a1.text, a1.type))
+            only1.add(a1)
+            stats['metrics total']['FN'] += 1
+            stats['metrics {}'.format(a1.type)]['FN'] += 1
+            stats['by type']['missed {}'.format(a1.type)] += 1
+    for a2 in ann2:
+        if a2 not in match2:
+            print('ONLY2: "{}" ({})'.format(a2.text, a2.type))
+            only2.add(a2)
+            stats['metrics total']['FP'] += 1
+            stats['metrics {}'.format(a2.type)]['FP'] += 1
+            stats['by type']['missed {}'.format(a2.type)] += 1
+    return stats
+
+
+def make_document(size, rng):
+    """Return two annotation lists for a dense synthetic document."""
+    length = size * 10
+    types = ['Gene', 'Chemical', 'Disease', 'Organism']
+    anns = []
+    for _ in range(2):
+        ann = []
+        for i in range(size):
+            start = rng.randint(0, length)
+            end = start + rng.randint(1, 30)
+            ann.append(Textbound('T{}'.format(i+1), rng.choice(types),
+                                 '{} {}'.format(start, end), 'x'*(end-start)))
+        anns.append(ann)
+    # share half of the spans for exact matches
+    for i in range(0, size, 2):
+        a = anns[0][i]
+        anns[1][i] = Textbound(anns[1][i].id, a.type, a.span, a.text)
+    return anns
+
+
+def run(compare, ann1, ann2, options):
+    stats = defaultdict(lambda: defaultdict(int))
+    out = io.StringIO()
+    with redirect_stdout(out):
+        compare(ann1, ann2, options, stats, 'doc')
+    # compare_annotations() also prints a document score and doc-level
+    # stats, which the legacy copy omits
+    lines = [l for l in out.getvalue().splitlines()
+             if not l.startswith('SCORE')]
+    stats.pop('doc-level', None)
+    return lines, {k: dict(v) for k, v in stats.items()}
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    rng = random.Random(0)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        ann1, ann2 = make_document(size, rng)
+        for overlap in (False, True):
+            options = Namespace(overlap=overlap, maptypes=False,
+                                retype=None, filtertypes=None,
+                                forcemap=False)
+            legacy = run(legacy_compare_annotations, ann1, ann2, options)
+            indexed = run(compare_annotations, ann1, ann2, options)
+            assert legacy == indexed, 'results differ'
+            times = []
+            for compare in (legacy_compare_annotations, compare_annotations):
+                times.append(min(timeit.repeat(
+                    lambda: run(compare, ann1, ann2, options), number=1,
+                    repeat=args.repeat)))
+            print('{} annotations, {}: nested loop {:.3f}s, index {:.3f}s, '
+                  'speedup {:.1f}x'.format(
+                      size, 'overlap' if overlap else 'exact', times[0],
+                      times[1], times[0]/times[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
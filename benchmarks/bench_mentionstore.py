@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Benchmark aggregate counts (mentions by type, by serial and per
+# document) over a mention store (see tagged2columns.py) against
+# parsing the tagger TSV with Mention.from_tsv, on synthetic or given
+# tags.
+
+import sys
+import os
+import random
+import tempfile
+import timeit
+
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from common import Mention, skippable_line
+from mentionstore import MentionStore, MentionStoreWriter, value_counts
+from mentionstore import numpy
+from tagged2columns import convert
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('-m', '--mentions', type=int, default=1000000,
+                    help='number of synthetic mentions (default 1000000)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='number of timing runs (default 3)')
+    ap.add_argument('tags', nargs='?', default=None,
+                    help='tags file (default synthetic)')
+    return ap
+
+
+def make_synthetic(fn, count):
+    rng = random.Random(0)
+    types = [-1, -2, -26, -25, 9606, 10090]
+    with open(fn, 'w') as f:
+        pmid = 1
+        for i in range(count):
+            if rng.random() < 0.02:
+                pmid += 1
+            start = rng.randint(0, 2000)
+            text = 'term{}'.format(rng.randint(0, 50000))
+            print('\t'.join(str(v) for v in (
+                pmid, 1, 1, start, start+len(text)-1, text,
+                rng.choice(types), rng.randint(1, 10**6))), file=f)
+
+
+def counts_from_tsv(fn):
+    by_type, by_serial, by_pmid = Counter(), Counter(), Counter()
+    with open(fn) as f:
+        for ln, line in enumerate(f, start=1):
+            if skippable_line(line):
+                continue
+            m = Mention.from_tsv(line, ln, fn)
+            by_type[m.type] += 1
+            by_serial[m.serial] += 1
+            by_pmid[m.pmid] += 1
+    return by_type, by_serial, by_pmid
+
+
+def counts_from_store(dirname):
+    store = MentionStore(dirname)
+    return tuple(value_counts(store.column(c))
+                 for c in ('type', 'serial', 'pmid'))
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if numpy is None:
+        print('NumPy not installed, store counts are not vectorized')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = args.tags
+        if fn is None:
+            fn = os.path.join(tmpdir, 'tags.tsv')
+            make_synthetic(fn, args.mentions)
+        storedir = os.path.join(tmpdir, 'store')
+        store = MentionStoreWriter(storedir)
+        t = timeit.timeit(lambda: convert(fn, store), number=1)
+        store.close()
+        print('\nconversion: {:.3f}s'.format(t))
+        expected = counts_from_tsv(fn)
+        assert [dict(c) for c in counts_from_store(storedir)] == \
+            [{int(k): v for k, v in c.items()} for c in expected]
+        results = []
+        for name, func, arg in (('TSV parse', counts_from_tsv, fn),
+                                ('mention store', counts_from_store,
+                                 storedir)):
+            t = min(timeit.repeat(lambda: func(arg), number=1,
+                                  repeat=args.repeat))
+            results.append(t)
+            print('{}: {:.3f}s'.format(name, t))
+        print('speedup: {:.2f}x'.format(results[0]/results[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
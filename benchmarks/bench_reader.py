@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Benchmark common.read_batches() against the LookaheadIterator-based
+# reader it replaced, on synthetic or given docs and tags files.
+
+import sys
+import os
+import random
+import collections
+import tempfile
+import timeit
+
+from itertools import tee
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from common import Document, Mention, skippable_line, read_batches
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('-d', '--docs', type=int, default=20000,
+                    help='number of synthetic documents (default 20000)')
+    ap.add_argument('-m', '--mentions', type=int, default=50,
+                    help='mentions per synthetic document (default 50)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='number of timing runs (default 3)')
+    ap.add_argument('files', nargs='*', metavar='DOCS TAGS',
+                    help='docs and tags files (default synthetic)')
+    return ap
+
+
+class LookaheadIterator(collections.abc.Iterator):
+    """Lookahead iterator from http://stackoverflow.com/a/1518097."""
+
+    def __init__(self, it, start=0):
+        self._it, self._nextit = tee(iter(it))
+        self.index = start - 1
+        self._advance()
+
+    def _advance(self):
+        self.lookahead = next(self._nextit, None)
+        self.index = self.index + 1
+
+    def __next__(self):
+        self._advance()
+        return next(self._it)
+
+    def __bool__(self):
+        return self.lookahead is not None
+
+
+def legacy_read_streams(docs, tags):
+    # read_streams() before the read_batches() engine
+    tag_it = LookaheadIterator(tags, start=1)
+    for doc_ln, doc_line in enumerate(docs, start=1):
+        document = Document.from_tsv(doc_line, doc_ln, docs.name)
+        doc_text = document.text
+        mentions = []
+        while tag_it:
+            if skippable_line(tag_it.lookahead):
+                next(tag_it)
+                continue
+            elif tag_it.lookahead.split('\t')[0] != document.pmid:
+                break
+            tag_line, tag_ln = next(tag_it), tag_it.index
+            mention = Mention.from_tsv(tag_line, tag_ln, tags.name)
+            mention.validate_text(doc_text)
+            mentions.append(mention)
+        yield document, mentions
+
+
+WORDS = ['protein', 'kinase', 'cell', 'mouse', 'human', 'cancer', 'insulin',
+         'receptor', 'expression', 'gene', 'binding', 'liver', 'tumor']
+
+
+def make_synthetic(dirname, doc_count, mention_count):
+    docfn = os.path.join(dirname, 'docs.tsv')
+    tagfn = os.path.join(dirname, 'tags.tsv')
+    rng = random.Random(0)
+    with open(docfn, 'w') as docf, open(tagfn, 'w') as tagf:
+        for pmid in range(1, doc_count+1):
+            words = [rng.choice(WORDS) for _ in range(mention_count*2)]
+            title, abstract = 'Title', ' '.join(words)
+            print('\t'.join(['PMID:{}'.format(pmid), '<AUTHORS>', '<JOURNAL>',
+                             '<YEAR>', title, abstract]), file=docf)
+            offset = len(title) + 1
+            for i, word in enumerate(words):
+                if i % 2 == 0:
+                    print('\t'.join(str(f) for f in [
+                        pmid, 1, 1, offset, offset+len(word)-1, word, -1,
+                        i]), file=tagf)
+                offset += len(word) + 1
+    return docfn, tagfn
+
+
+def run_legacy(docfn, tagfn):
+    count = 0
+    with open(docfn) as docf, open(tagfn) as tagf:
+        for document, mentions in legacy_read_streams(docf, tagf):
+            count += len(mentions)
+    return count
+
+
+def run_batches(docfn, tagfn):
+    count = 0
+    with open(docfn) as docf, open(tagfn) as tagf:
+        for batch in read_batches(docf, tagf):
+            for document, mentions in batch:
+                count += len(mentions)
+    return count
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.files:
+            docfn, tagfn = args.files
+        else:
+            docfn, tagfn = make_synthetic(tmpdir, args.docs, args.mentions)
+        assert run_legacy(docfn, tagfn) == run_batches(docfn, tagfn)
+        results = []
+        for name, func in (('legacy read_streams', run_legacy),
+                           ('read_batches', run_batches)):
+            t = min(timeit.repeat(lambda: func(docfn, tagfn), number=1,
+                                  repeat=args.repeat))
+            results.append(t)
+            print('{}: {:.3f}s'.format(name, t))
+        print('speedup: {:.2f}x'.format(results[0]/results[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
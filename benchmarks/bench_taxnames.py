@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Benchmark tagged2standoff.py cold start with the taxid-name lookup
+# table against loading data/taxnames.tsv into a dict, as done before
+# the table was introduced. Each run is a fresh process.
+
+import sys
+import os
+import random
+import subprocess
+import tempfile
+import timeit
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'scripts')
+
+EXAMPLES = os.path.join(SCRIPTS, '..', 'examples')
+
+# Run tagged2standoff.main(), optionally with the dict-based loader
+RUNNER = '''
+import sys
+sys.path.insert(0, {scripts!r})
+import common
+if {legacy!r}:
+    def load_taxid_name_map(fn):
+        taxid_name_map = {{}}
+        with open(fn) as f:
+            for line in f:
+                id_, name = line.rstrip('\\n').split('\\t')
+                taxid_name_map[int(id_)] = name
+        return taxid_name_map
+    common.load_taxid_name_map = load_taxid_name_map
+import tagged2standoff
+tagged2standoff.main(['tagged2standoff.py', '-d', 'out'] + {files!r})
+'''
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('-n', '--names', type=int, default=2500000,
+                    help='number of synthetic taxnames (default 2500000)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='number of timing runs (default 3)')
+    ap.add_argument('taxnames', nargs='?', default=None,
+                    help='taxnames.tsv (default synthetic)')
+    return ap
+
+
+def make_synthetic(fn, count):
+    rng = random.Random(0)
+    # include the species in the examples
+    ids = [9606, 10090, 10116, 4932, 559292, 7227, 6239, 3702, 4896]
+    ids += rng.sample(range(10**7), count - len(ids))
+    with open(fn, 'w') as f:
+        for id_ in ids:
+            print('{}\tTaxon {}'.format(id_, id_), file=f)
+
+
+def run(dirname, legacy):
+    files = [os.path.join(EXAMPLES, 'example-docs.tsv'),
+             os.path.join(EXAMPLES, 'example-tags.tsv')]
+    code = RUNNER.format(scripts=SCRIPTS, legacy=legacy, files=files)
+    subprocess.run([sys.executable, '-c', code], cwd=dirname, check=True,
+                   stderr=subprocess.DEVNULL)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.mkdir(os.path.join(tmpdir, 'data'))
+        fn = os.path.join(tmpdir, 'data', 'taxnames.tsv')
+        if args.taxnames:
+            with open(args.taxnames) as src, open(fn, 'w') as dst:
+                dst.writelines(src)
+        else:
+            make_synthetic(fn, args.names)
+        t = timeit.timeit(lambda: run(tmpdir, False), number=1)
+        print('first run, building table: {:.3f}s'.format(t))
+        results = []
+        for name, legacy in (('dict from TSV', True),
+                             ('lookup table', False)):
+            t = min(timeit.repeat(lambda: run(tmpdir, legacy), number=1,
+                                  repeat=args.repeat))
+            results.append(t)
+            print('{}: {:.3f}s'.format(name, t))
+        print('speedup: {:.2f}x'.format(results[0]/results[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,51 @@
+#!/bin/bash
+
+# Check incremental conversion (tagged2standoff.py -I) of the examples:
+# a rerun on unchanged input changes nothing, a rerun stopped by
+# --limit does not remove output for documents it did not reach, and a
+# rerun with different output options is refused.
+
+set -euo pipefail
+
+# https://stackoverflow.com/a/246128
+BASEDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+INDIR="$BASEDIR/examples"
+
+TMPDIR=$(mktemp -d)
+function rmtemp {
+    rm -rf "$TMPDIR"
+}
+trap rmtemp EXIT
+
+function convert {
+    python3 "$BASEDIR/scripts/tagged2standoff.py" \
+        -I "$TMPDIR/manifest.sqlite" -d "$TMPDIR/standoff" "$@" \
+        "$INDIR"/example-{docs,tags}.tsv 2>&1 | grep 'manifest.sqlite:'
+}
+
+function check {
+    if [[ "$1" != *"$2"* ]]; then
+        echo "FAILED: expected \"$2\", got \"$1\"" >&2
+        exit 1
+    fi
+}
+
+function file_count {
+    find "$TMPDIR/standoff" -type f | wc -l
+}
+
+convert >/dev/null
+FILES=$(file_count)
+
+check "$(convert)" "0 added, 0 changed, 0 removed"
+check "$(convert -l 10)" ", 0 removed"
+check "$(file_count)" "$FILES"
+
+# output options are fixed for a manifest
+if convert -P 2 >/dev/null; then
+    echo "FAILED: manifest used with different --dir-prefix" >&2
+    exit 1
+fi
+
+echo "Done, incremental conversion OK ($FILES files)"
@@ -0,0 +1,64 @@
+# Checkpoints for resuming long-running database builds.
+
+import os
+import pickle
+
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+LOG_SUFFIX = '.checkpoint-log'
+
+
+def checkpoint_path(dbname):
+    return dbname + CHECKPOINT_SUFFIX
+
+
+def file_signature(fn):
+    """Return (size, mtime) identifying the current version of a file."""
+    stat = os.stat(fn)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def save_checkpoint(dbname, state):
+    """Atomically store checkpoint state (a dict) for DB."""
+    fn = checkpoint_path(dbname)
+    tmpfn = fn + '.tmp'
+    with open(tmpfn, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpfn, fn)
+
+
+def load_checkpoint(dbname):
+    """Return checkpoint state for DB, or None if there is none."""
+    try:
+        with open(checkpoint_path(dbname), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def log_path(dbname):
+    return dbname + LOG_SUFFIX
+
+
+def reset_checkpoint_log(dbname):
+    """Start an empty checkpoint log for DB."""
+    open(log_path(dbname), 'wb').close()
+
+
+def append_checkpoint_log(dbname, record):
+    """Append record to the checkpoint log of DB and return the log size,
+    to be stored in the checkpoint that covers the record."""
+    with open(log_path(dbname), 'ab') as f:
+        pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return f.tell()
+
+
+def read_checkpoint_log(dbname, size):
+    """Iterate over the records in the first size bytes of the checkpoint
+    log of DB, discarding any written after the checkpoint."""
+    fn = log_path(dbname)
+    with open(fn, 'r+b') as f:
+        f.truncate(size)
+        while f.tell() < size:
+            yield pickle.load(f)
@@ -0,0 +1,51 @@
+# Parallel parsing of input files in newline-aligned byte chunks.
+
+import os
+
+from functools import partial
+from multiprocessing import Pool
+
+
+DEFAULT_CHUNK_SIZE = 2**24
+
+
+def file_chunks(fn, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return (start, end) byte ranges covering fn, ending at newlines."""
+    size = os.path.getsize(fn)
+    chunks, start = [], 0
+    with open(fn, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size) - 1)
+            f.readline()    # to end of line
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def read_chunk(fn, start, end):
+    """Return lines in byte range of fn, without newlines."""
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()    # after final newline
+    return lines
+
+
+def parse_chunk(fn, parse, chunk):
+    return parse(read_chunk(fn, *chunk))
+
+
+def map_chunks(fn, parse, workers, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield parse(lines) for chunks of fn in file order.
+
+    The chunks are read and parsed in a pool of workers processes;
+    parse must be picklable (e.g. a module-level function or a partial
+    of one) and should return compact results, as they are passed back
+    to the calling process.
+    """
+    chunks = file_chunks(fn, chunk_size)
+    with Pool(workers) as pool:
+        yield from pool.imap(partial(parse_chunk, fn, parse), chunks)
@@ -3,15 +3,35 @@
 import sys
 import os
 
+from array import array
 from collections import OrderedDict
+from contextlib import ExitStack
+from itertools import groupby
 from logging import warning, error
 
-from common import type_name, rewrite_norm_id
+from common import type_name, rewrite_norm_id, resolution_value, FormatError
+from normdb import write_lookup_table
+from fileio import open_input, is_plain_file
+from chunkparse import map_chunks
+from extsort import ExternalSorter, DEFAULT_MEMORY
 
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
+    ap.add_argument('-w', '--workers', type=int, metavar='INT', default=None,
+                    help='number of parsing processes (uncompressed input)')
+    ap.add_argument('-R', '--resolution', metavar='TABLE', default=None,
+                    help='also write resolution table of entities to TABLE '
+                    '(for tagged2standoff.py -R)')
+    ap.add_argument('-s', '--streaming', default=False, action='store_true',
+                    help='sort inputs on disk and merge (bounded memory)')
+    ap.add_argument('-M', '--memory', metavar='MB', type=int,
+                    default=DEFAULT_MEMORY//2**20,
+                    help='memory budget for --streaming (default {})'.\
+                    format(DEFAULT_MEMORY//2**20))
+    ap.add_argument('-T', '--tmpdir', default=None,
+                    help='directory for --streaming temporary files')
     ap.add_argument('preferred', metavar='PREF-TSV',
                     help='preferred entity names')
     ap.add_argument('names', metavar='NAME-TSV',
@@ -21,43 +41,78 @@ def argparser():
     return ap
 
 
-def load_names(fn, names=None):
+# Approximate size of input parsed at a time without --workers
+READ_CHUNK = 2**22
+
+
+def parse_names(lines):
+    """Return (count, serials, names, error indices) for lines."""
+    serials, names, errors = [], [], []
+    for i, l in enumerate(lines):
+        try:
+            l = l.decode('utf-8')
+        except:
+            errors.append(i)
+            continue
+        l = l.rstrip()
+        fields = l.split('\t')
+        serial, name = fields
+        serials.append(serial)
+        names.append(name)
+    return len(lines), serials, names, errors
+
+
+def parse_entities(lines):
+    """Return (count, serials, (type, id) pairs, []) for lines."""
+    serials, values = [], []
+    for l in lines:
+        l = l.decode('utf-8').rstrip()
+        fields = l.split('\t')
+        serial, type_, id_ = fields
+        serials.append(serial)
+        values.append((type_, id_))
+    return len(lines), serials, values, []
+
+
+def parse_file(fn, parse, workers):
+    """Yield results of parse for chunks of lines of fn in order."""
+    if workers is not None and workers > 1:
+        yield from map_chunks(fn, parse, workers)
+    else:
+        # binary mode as there are in cases encoding issues in this data.
+        with open_input(fn, 'rb') as f:
+            for lines in iter(lambda: f.readlines(READ_CHUNK), []):
+                yield parse(lines)
+
+
+def load_names(fn, names=None, workers=None):
     if names is None:
         names = {}
     read_count, error_count, store_count = 0, 0, 0
-    # binary mode as there are in cases encoding issues in this data.
-    with open(fn, 'rb') as f:
-        for ln, l in enumerate(f, start=1):
-            try:
-                l = l.decode('utf-8')
-            except:
-                error('line {} in {}'.format(ln, fn))
-                error_count += 1
-                continue
-            l = l.rstrip()
-            fields = l.split('\t')
-            serial, name = fields
+    for count, serials, values, errors in parse_file(fn, parse_names,
+                                                     workers):
+        for i in errors:
+            error('line {} in {}'.format(read_count+error_count+i+1, fn))
+        error_count += len(errors)
+        for serial, name in zip(serials, values):
             if serial not in names:
                 names[serial] = name
                 store_count += 1
-            read_count += 1
+        read_count += count - len(errors)
     print('read {} names, stored {} from {} ({} errors)'.format(
         read_count, store_count, fn, error_count), file=sys.stderr)
     return names
 
 
-def load_entities(fn):
+def load_entities(fn, workers=None):
     entities = OrderedDict()
     read_count, store_count = 0, 0
-    with open(fn) as f:
-        for ln, l in enumerate(f, start=1):
-            l = l.rstrip()
-            fields = l.split('\t')
-            serial, type_, id_ = fields
+    for count, serials, values, _ in parse_file(fn, parse_entities, workers):
+        for serial, value in zip(serials, values):
             if serial not in entities:
-                entities[serial] = (type_, id_)
+                entities[serial] = value
                 store_count += 1
-            read_count += 1
+        read_count += count
     print('read {} entities, stored {} from {}'.format(
         read_count, store_count, fn), file=sys.stderr)
     return entities
@@ -71,25 +126,199 @@ def make_organism_name_map(names, entities):
     return organism_name
 
 
+def write_resolution_table(fn, names, entities):
+    """Write lookup table of resolved entities, see
+    common.resolve_mention().
+    """
+    keys, values = array('q'), []
+    for serial, (type_, id_) in entities.items():
+        try:
+            value = resolution_value(type_, id_, names.get(serial))
+        except (ValueError, FormatError) as e:
+            warning('not resolving {}: {}'.format(serial, e))
+            continue
+        keys.append(int(serial))
+        values.append(value)
+    count = write_lookup_table(fn, keys, values)
+    print('wrote {} entities to {}'.format(count, fn), file=sys.stderr)
+
+
+def combined_line(serial, type_, id_, name, organism):
+    if organism is not None:
+        name = '{} ({})'.format(name, organism)    # attach organism
+    id_ = rewrite_norm_id(id_, type_name(type_), organism)
+    return '\t'.join([serial, name, id_])
+
+
+def first_field(line):
+    return line.split('\t', 1)[0]
+
+
+def split_line(line):
+    return line.rstrip('\n').split('\t')
+
+
+def first_by_key(lines):
+    """Yield split first line for each key in lines sorted by key."""
+    for _, group in groupby(lines, key=first_field):
+        yield split_line(next(group))
+
+
+def last_by_key(lines):
+    """Yield split last line for each key in lines sorted by key."""
+    for _, group in groupby(lines, key=first_field):
+        for line in group:
+            pass
+        yield split_line(line)
+
+
+def sort_names(sorter, fns, workers):
+    """Add "serial, name, source index" lines to ExternalSorter and
+    return (read, error) counts for each file.
+    """
+    counts = []
+    for src, fn in enumerate(fns):
+        read_count, error_count = 0, 0
+        for count, serials, values, errors in parse_file(fn, parse_names,
+                                                         workers):
+            for i in errors:
+                error('line {} in {}'.format(read_count+error_count+i+1, fn))
+            error_count += len(errors)
+            for serial, name in zip(serials, values):
+                sorter.add('{}\t{}\t{}\n'.format(serial, name, src))
+            read_count += count - len(errors)
+        counts.append((read_count, error_count))
+    return counts
+
+
+def sort_entities(sorter, fn, workers):
+    """Add "serial, type, id, line index" lines to ExternalSorter and
+    return the number of lines.
+    """
+    read_count = 0
+    for count, serials, values, _ in parse_file(fn, parse_entities, workers):
+        for i, (serial, (type_, id_)) in enumerate(zip(serials, values)):
+            sorter.add('{}\t{}\t{}\t{}\n'.format(serial, type_, id_,
+                                                 read_count+i))
+        read_count += count
+    return read_count
+
+
+def merge_join(left, right):
+    """Yield (left, right) for lists with equal first items from
+    iterators of lists sorted by first item, which must be unique.
+    """
+    left, right = iter(left), iter(right)
+    l, r = next(left, None), next(right, None)
+    while l is not None and r is not None:
+        if l[0] < r[0]:
+            l = next(left, None)
+        elif l[0] > r[0]:
+            r = next(right, None)
+        else:
+            yield l, r
+            l, r = next(left, None), next(right, None)
+
+
+def counted(items, counts, index=None):
+    """Yield items, counting them in counts (by item[index] if given)."""
+    for item in items:
+        counts[0 if index is None else int(item[index])] += 1
+        yield item
+
+
+# Number of ExternalSorters holding lines at once in combine_streaming()
+STREAMING_SORTERS = 5
+
+
+def combine_streaming(args):
+    """Combine dictionaries with external sorts and merge joins.
+
+    Memory use is bounded by args.memory, shared equally by the sorts,
+    all of which hold lines in memory during the join.
+    """
+    memory = args.memory * 2**20 // STREAMING_SORTERS
+    tmpdir = args.tmpdir
+    name_fns = (args.preferred, args.names)
+    # Join entities to names by serial. Organisms are sorted by ID and
+    # gene records by taxid for the join attaching organism names,
+    # others go directly to the final sort by entity line index.
+    by_id_index = lambda line: (first_field(line),
+                                int(line.split('\t', 2)[1]))
+    by_index = lambda line: int(first_field(line))
+    name_stored, entity_stored = [0] * len(name_fns), [0]
+    # Sorters are closed (removing their runs) also on errors
+    with ExitStack() as stack:
+        names, entities, genes, organisms, output = (
+            stack.enter_context(ExternalSorter(key, memory, tmpdir))
+            for key in (first_field, first_field, first_field, by_id_index,
+                        by_index))
+        name_counts = sort_names(names, name_fns, args.workers)
+        entity_count = sort_entities(entities, args.entities, args.workers)
+        unique_names = counted(first_by_key(names), name_stored, 2)
+        unique_entities = counted(first_by_key(entities), entity_stored)
+        for (serial, name, _), (_, type_, id_, idx) in merge_join(
+                unique_names, unique_entities):
+            if type_ == '-2':
+                organisms.add('{}\t{}\t{}\n'.format(id_, idx, name))
+            if type_name(type_) == 'Gene':
+                genes.add('{}\t{}\t{}\t{}\t{}\n'.format(type_, idx, serial,
+                                                        name, id_))
+            else:
+                output.add('{}\t{}\n'.format(idx, combined_line(
+                    serial, type_, id_, name, None)))
+        for fn, (read_count, error_count), store_count in zip(
+                name_fns, name_counts, name_stored):
+            print('read {} names, stored {} from {} ({} errors)'.format(
+                read_count, store_count, fn, error_count), file=sys.stderr)
+        print('read {} entities, stored {} from {}'.format(
+            entity_count, entity_stored[0], args.entities), file=sys.stderr)
+        # Last organism name for each ID as in make_organism_name_map()
+        organism_names = last_by_key(organisms)
+        organism = next(organism_names, None)
+        for type_, group in groupby(genes, key=first_field):
+            while organism is not None and organism[0] < type_:
+                organism = next(organism_names, None)
+            if organism is not None and organism[0] == type_:
+                organism_name = organism[2]
+            else:
+                organism_name = '<UNKNOWN>'
+            for line in group:
+                _, idx, serial, name, id_ = split_line(line)
+                output.add('{}\t{}\n'.format(idx, combined_line(
+                    serial, type_, id_, name, organism_name)))
+        for line in output:
+            print(line.split('\t', 1)[1], end='')
+
+
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    names = load_names(args.preferred)
-    names = load_names(args.names, names)
-    entities = load_entities(args.entities)
+    if (args.workers is not None and args.workers > 1 and
+        not all(is_plain_file(fn) for fn in (args.preferred, args.names,
+                                             args.entities))):
+        error('--workers requires uncompressed files')
+        return 1
+    if args.streaming and args.resolution:
+        error('--resolution is not supported with --streaming')
+        return 1
+    if args.streaming:
+        combine_streaming(args)
+        return 0
+    names = load_names(args.preferred, workers=args.workers)
+    names = load_names(args.names, names, workers=args.workers)
+    entities = load_entities(args.entities, workers=args.workers)
+    if args.resolution:
+        write_resolution_table(args.resolution, names, entities)
     organism_name = make_organism_name_map(names, entities)
     for serial, (type_, id_) in entities.items():
         if serial not in names:
             continue    # couldn't be tagged
         name = names[serial]
-        typename = type_name(type_)
-        if typename == 'Gene':
+        if type_name(type_) == 'Gene':
             organism = organism_name.get(type_, '<UNKNOWN>')
         else:
             organism = None
-        if organism is not None:
-            name = '{} ({})'.format(name, organism)    # attach organism
-        id_ = rewrite_norm_id(id_, typename, organism)
-        print('\t'.join([serial, name, id_]))
+        print(combined_line(serial, type_, id_, name, organism))
     return 0
 
 
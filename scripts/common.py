@@ -1,9 +1,16 @@
 import sys
+import os
+import pickle
 import collections
 
-from itertools import tee
+from array import array
+from collections import namedtuple
+from itertools import chain, islice
 from logging import info, warning, error
 
+from normdb import bulk_get, LookupTable, write_lookup_table, LUT_SUFFIX
+from checkpoint import file_signature
+
 
 # From https://bitbucket.org/larsjuhljensen/tagger/
 TYPE_MAP = {
@@ -47,24 +54,42 @@ class FormatError(Exception):
     pass
 
 
-class LookaheadIterator(collections.abc.Iterator):
-    """Lookahead iterator from http://stackoverflow.com/a/1518097."""
+def decode_line(line):
+    """Decode line read from binary file as if read in text mode."""
+    if line.endswith(b'\r\n'):
+        line = line[:-2] + b'\n'
+    return line.decode('utf-8')
+
 
-    def __init__(self, it, start=0):
-        self._it, self._nextit = tee(iter(it))
-        self.index = start - 1
-        self._advance()
+class LineReader(collections.abc.Iterator):
+    """Iterate over the lines in byte range [start, end) of a UTF-8 file."""
 
-    def _advance(self):
-        self.lookahead = next(self._nextit, None)
-        self.index = self.index + 1
+    def __init__(self, fn, start=0, end=None):
+        self.name = fn
+        self.offset = start    # byte offset of next line
+        self.last_size = 0    # size of last line in bytes
+        self.end = end
+        self._f = open(fn, 'rb')
+        self._f.seek(start)
 
     def __next__(self):
-        self._advance()
-        return next(self._it)
+        if self.end is not None and self.offset >= self.end:
+            raise StopIteration
+        line = self._f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        self.last_size = len(line)
+        return decode_line(line)
+
+    def close(self):
+        self._f.close()
 
-    def __bool__(self):
-        return self.lookahead is not None
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class Document(object):
@@ -109,7 +134,7 @@ class Mention(object):
         self.type = int(type_)
         self.serial = int(serial)
 
-        self.typename, self.species = typename_and_species(self.type)
+        self.typename, self.species = type_info(self.type)
 
     def validate_text(self, text):
         ref = text[self.start: self.end]
@@ -124,32 +149,283 @@ class Mention(object):
 
     @classmethod
     def from_tsv(cls, line, ln, fn):
-        line = line.rstrip('\n')
-        fields = line.split('\t')
+        return cls.from_fields(line.rstrip('\n').split('\t'), ln, fn)
+
+    @classmethod
+    def from_fields(cls, fields, ln, fn):
         if len(fields) != 8:
             raise FormatError('line {} in {}: expected 8 fields, got {}: {}'.\
-                              format(ln, fn, len(fields), line))
+                              format(ln, fn, len(fields), '\t'.join(fields)))
         return cls(*fields)
 
 
-def get_norm_name(id_, default, options):
-    if id_ not in get_norm_name._cache:
-        if options.namedb is None:
+class MentionBatch(object):
+    """Mentions as typed arrays (struct-of-arrays) with interned texts.
+
+    Columns are as in Mention, with end offsets exclusive and document
+    IDs kept as (interned) strings. Typename and species are resolved
+    per distinct type with type_info().
+    """
+
+    def __init__(self, pmid=(), para=(), sent=(), start=(), end=(), text=(),
+                 type_=(), serial=()):
+        self.pmid = list(pmid)
+        self.para = array('i', para)
+        self.sent = array('i', sent)
+        self.start = array('i', start)
+        self.end = array('i', end)
+        self.text = list(text)
+        self.type = array('i', type_)
+        self.serial = array('q', serial)
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, i):
+        return Mention(self.pmid[i], self.para[i], self.sent[i],
+                       self.start[i], self.end[i]-1, self.text[i],
+                       self.type[i], self.serial[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def validate_text(self, text):
+        for i, (start, end, mtext) in enumerate(zip(self.start, self.end,
+                                                    self.text)):
+            if mtext != text[start:end]:
+                assert False, 'Text mismatch in {}: "{}" vs "{}"'.format(
+                    self.pmid[i], mtext, text[start:end])
+
+    @classmethod
+    def from_fields(cls, rows):
+        """Return MentionBatch for lists of 8 tagger TSV fields."""
+        if not rows:
+            return cls()
+        pmid, para, sent, start, end, text, type_, serial = zip(*rows)
+        return cls(map(sys.intern, pmid), map(int, para), map(int, sent),
+                   map(int, start), [int(e)+1 for e in end],
+                   map(sys.intern, text), map(int, type_), map(int, serial))
+
+
+class LRUCache(object):
+    """Mapping of at most max_size entries, evicting least recently used.
+
+    get() counts hits and misses; peek() and __contains__ do not count
+    or affect recency.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
             return default
-        else:
-            get_norm_name._cache[id_] = options.namedb.get(id_, default)
-    return get_norm_name._cache[id_]
-get_norm_name._cache = {}
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def items(self):
+        return self.data.items()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return '{} hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+            self.hits, self.misses, self.hits/total if total else 0,
+            self.evictions)
+
+
+DEFAULT_CACHE_SIZE = 2**20
+
+# Caches map IDs to DB values, or None for IDs not in DB.
+NORM_CACHES = {
+    'name': LRUCache(DEFAULT_CACHE_SIZE),
+    'id': LRUCache(DEFAULT_CACHE_SIZE),
+}
+
+MISSING = object()
+
+
+def norm_dbs(options):
+    """Return (DB, cache) pairs for name and entity DBs."""
+    return ((options.namedb, NORM_CACHES['name']),
+            (options.entitydb, NORM_CACHES['id']))
+
+
+def lookup_norm(db, cache, id_):
+    value = cache.get(id_, MISSING)
+    if value is MISSING:
+        bulk_get.round_trips += 1
+        value = cache[id_] = db.get(id_)
+    return value
+
+
+def get_norm_name(id_, default, options):
+    if options.namedb is None:
+        return default
+    value = NORM_CACHES['name'].peek(id_, MISSING)    # prefetched
+    if value is MISSING:
+        value = lookup_norm(options.namedb, NORM_CACHES['name'], id_)
+    return default if value is None else value
 
 
 def get_norm_id(id_, default, options):
-    if id_ not in get_norm_id._cache:
-        if options.entitydb is None:
-            return default
-        else:
-            get_norm_id._cache[id_] = options.entitydb.get(id_, default)
-    return get_norm_id._cache[id_]
-get_norm_id._cache = {}
+    if options.entitydb is None:
+        return default
+    value = NORM_CACHES['id'].peek(id_, MISSING)    # prefetched
+    if value is MISSING:
+        value = lookup_norm(options.entitydb, NORM_CACHES['id'], id_)
+    return default if value is None else value
+
+
+def prefetch_norms(batch, options):
+    """Look up names and IDs for (document, mentions) pairs in batch.
+
+    Distinct serials not in cache are queried from the name and entity
+    DBs in bulk (see normdb.bulk_get()) so that get_norm_name() and
+    get_norm_id() need no DB queries for the batch. Serials in the
+    resolution table are skipped. Cache hits and misses are counted per
+    distinct serial in batch. At most the cache size of serials are
+    prefetched, so that none is evicted before use; the rest are looked
+    up when needed.
+    """
+    serials = set()
+    for document, mentions in batch:
+        serials.update(mentions.serial)
+    if options.resolution is not None:
+        serials = [s for s in serials if s not in options.resolution]
+    for db, cache in norm_dbs(options):
+        if db is None:
+            continue
+        missing = [s for s in islice(serials, cache.max_size)
+                   if cache.get(s, MISSING) is MISSING]
+        if missing:
+            found = bulk_get(db, missing)
+            for serial in missing:
+                cache[serial] = found.get(serial)
+
+
+def set_norm_cache_size(max_size):
+    for cache in NORM_CACHES.values():
+        cache.max_size = max_size
+
+
+def norm_stats():
+    """Return DB round trips and (hits, misses, evictions) by cache."""
+    return bulk_get.round_trips, {k: (c.hits, c.misses, c.evictions)
+                                  for k, c in NORM_CACHES.items()}
+
+
+def reset_norm_stats():
+    bulk_get.round_trips = 0
+    for cache in NORM_CACHES.values():
+        cache.hits, cache.misses, cache.evictions = 0, 0, 0
+
+
+def add_norm_stats(stats):
+    """Add counts from norm_stats() in another process."""
+    round_trips, counts = stats
+    bulk_get.round_trips += round_trips
+    for key, (hits, misses, evictions) in counts.items():
+        cache = NORM_CACHES[key]
+        cache.hits += hits
+        cache.misses += misses
+        cache.evictions += evictions
+
+
+def report_norm_stats(options):
+    if options.namedb is None and options.entitydb is None:
+        return
+    print('DB round trips: {}'.format(bulk_get.round_trips), file=sys.stderr)
+    for key, cache in sorted(NORM_CACHES.items()):
+        print('{} cache: {}'.format(key, cache.stats()), file=sys.stderr)
+
+
+def load_norm_caches(fn, sources):
+    """Load caches saved with save_norm_caches() if sources match.
+
+    sources identifies the name and entity DBs (e.g. file signatures).
+    """
+    try:
+        with open(fn, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return
+    if state['sources'] != sources:
+        warning('DBs changed since {} was saved, not using it'.format(fn))
+        return
+    for key, cache in NORM_CACHES.items():
+        for id_, value in state['caches'][key][-cache.max_size:]:
+            cache[id_] = value
+    info('loaded {} cached values from {}'.format(
+        sum(len(c) for c in NORM_CACHES.values()), fn))
+
+
+def save_norm_caches(fn, sources):
+    state = {
+        'sources': sources,
+        'caches': {k: list(c.items()) for k, c in NORM_CACHES.items()},
+    }
+    tmpfn = fn + '.tmp'
+    with open(tmpfn, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpfn, fn)
+
+
+def add_species(name, species):
+    # if we have a species name, add it to the norm text
+    return name + ' ({})'.format(species) if species else name
+
+
+def resolve_mention(serial, type_, text, options):
+    """Return (typename, norm_id, norm_name) for mention.
+
+    Looks up the resolution table built with combinedicts.py -R if
+    given, falling back to the name and entity DBs for serials not in
+    the table or with a different type.
+    """
+    if options.resolution is not None:
+        value = options.resolution.get(serial)
+        if value is not None:
+            table_type, typename, norm_id, norm_name = value.split('\t')
+            if int(table_type) == type_:
+                if not norm_name:    # no name, use mention text
+                    norm_name = add_species(text, type_info(type_)[1])
+                return typename, norm_id, norm_name
+    typename, species = type_info(type_)
+    norm_name = add_species(get_norm_name(serial, text, options), species)
+    norm_id = get_norm_id(serial, 'TAGGER:{}'.format(serial), options)
+    norm_id = rewrite_norm_id(norm_id, typename, species)
+    return typename, norm_id, norm_name
+
+
+def resolution_value(type_, norm_id, name):
+    """Return resolution table value for entity, see resolve_mention()."""
+    typename, species = type_info(int(type_))
+    norm_id = rewrite_norm_id(norm_id, typename, species)
+    norm_name = '' if name is None else add_species(name, species)
+    return '\t'.join([type_, typename, norm_id, norm_name])
 
 
 def rewrite_norm_id(id_, typename, species):
@@ -179,33 +455,172 @@ def skippable_line(line):
     return len(line) == 0 or line.isspace() or line[0] == '#'
 
 
-def read_streams(docs, tags):
-    tag_it = LookaheadIterator(tags, start=1)
-    for doc_ln, doc_line in enumerate(docs, start=1):
+# Position in docs and tags files: byte offsets and numbers of the
+# next lines to read.
+Position = namedtuple('Position', 'doc_offset doc_ln tag_offset tag_ln')
+
+
+class Batch(list):
+    """List of (document, mentions) with position after last document.
+
+    The position is None unless reading from LineReaders.
+    """
+
+    def __init__(self, items=(), position=None):
+        super().__init__(items)
+        self.position = position
+
+
+# Number of documents per batch yielded by read_batches()
+DEFAULT_BATCH_SIZE = 256
+
+# Maximum number of extra lines to warn about at end of tags
+MAX_EXTRA_LINES = 10
+
+
+def read_batches(docs, tags, batch_size=DEFAULT_BATCH_SIZE, limit=None,
+                 doc_start=1, tag_start=1):
+    """Read docs and tags streams, yielding lists of (document, mentions).
+
+    Mentions are given as a MentionBatch for each document and batches
+    as Batch objects. Tag lines are grouped with the document whose PMID
+    they match and must be in the same order as the documents. Each tag
+    line is split once and the fields kept until the line is consumed.
+    Reading stops after limit documents if given; doc_start and
+    tag_start give the line numbers of the first lines of the streams.
+    """
+    tag_it = iter(tags)
+    next_tag_line = tag_it.__next__
+    tag_ln = tag_start - 1
+    fields = None    # fields of next unconsumed tag line
+    batch, total = Batch(), 0
+    with_position = hasattr(docs, 'offset') and hasattr(tags, 'offset')
+    for doc_ln, doc_line in enumerate(docs, start=doc_start):
+        if limit is not None and total >= limit:
+            break
         document = Document.from_tsv(doc_line, doc_ln, docs.name)
-        doc_text = document.text
-        mentions = []
-        while tag_it:
-            if skippable_line(tag_it.lookahead):
-                tag_line, tag_ln = next(tag_it), tag_it.index
-                warning('skipping line {} in {}: {}'.format(
-                    tag_ln, tags.name, tag_line.rstrip('\n')))
-                continue
-            elif tag_it.lookahead.split('\t')[0] != document.pmid:
+        pmid, doc_text = document.pmid, document.text
+        rows = []
+        while True:
+            if fields is None:
+                try:
+                    tag_line = next_tag_line()
+                except StopIteration:
+                    break
+                tag_ln += 1
+                if not tag_line or tag_line[0] == '#' or tag_line.isspace():
+                    warning('skipping line {} in {}: {}'.format(
+                        tag_ln, tags.name, tag_line.rstrip('\n')))
+                    continue
+                fields = tag_line.rstrip('\n').split('\t')
+            if fields[0] != pmid:
                 break    # tagged for next document
-            tag_line, tag_ln = next(tag_it), tag_it.index
-            mention = Mention.from_tsv(tag_line, tag_ln, tags.name)
-            mention.validate_text(doc_text)
-            mentions.append(mention)
-        yield document, mentions
-    for i, l in enumerate(tag_it, start=1):
-        l = l.rstrip('\n')
-        warning('extra line {} in {}: {}'.format(tag_it.index, tags.name, l))
-        if i >= 10:
+            if len(fields) != 8:
+                Mention.from_fields(fields, tag_ln, tags.name)    # raises
+            rows.append(fields)
+            fields = None
+        mentions = MentionBatch.from_fields(rows)
+        mentions.validate_text(doc_text)
+        batch.append((document, mentions))
+        total += 1
+        if len(batch) >= batch_size:
+            if with_position:
+                batch.position = stream_position(docs, doc_ln, tags, tag_ln,
+                                                 fields is not None)
+            yield batch
+            batch = Batch()
+        if limit is not None and total >= limit:
+            break    # before reading past the last document
+    if batch:
+        if with_position:
+            batch.position = stream_position(docs, doc_ln, tags, tag_ln,
+                                             fields is not None)
+        yield batch
+    if limit is not None and total >= limit:
+        return
+    pending = [] if fields is None else [(tag_ln, '\t'.join(fields))]
+    rest = ((ln, line.rstrip('\n'))
+            for ln, line in enumerate(tag_it, start=tag_ln+1))
+    for i, (ln, line) in enumerate(chain(pending, rest), start=1):
+        warning('extra line {} in {}: {}'.format(ln, tags.name, line))
+        if i >= MAX_EXTRA_LINES:
             warning('{} extra lines, ignoring rest'.format(i))
             break
 
 
+def stream_position(docs, doc_ln, tags, tag_ln, pending):
+    """Return Position after line doc_ln of docs and tag_ln of tags.
+
+    If pending, the last line read from tags is not consumed.
+    """
+    if pending:
+        return Position(docs.offset, doc_ln+1, tags.offset-tags.last_size,
+                        tag_ln)
+    else:
+        return Position(docs.offset, doc_ln+1, tags.offset, tag_ln+1)
+
+
+def read_streams(docs, tags, doc_start=1, tag_start=1):
+    """Read docs and tags streams, yielding (document, mentions) pairs."""
+    # Batches of one so that nothing is read ahead of the consumer.
+    for batch in read_batches(docs, tags, 1, None, doc_start, tag_start):
+        yield batch[0]
+
+
+# Range of a docs file and the matching range of a tags file as start
+# and end Positions (end tag_offset None for end of file) with the
+# number of documents in the range.
+Shard = namedtuple('Shard', 'start end count')
+
+
+def shard_streams(docfn, tagfn, max_size, limit=None, start=None):
+    """Split docs and tags files into shards aligned with documents.
+
+    Walks the files in lockstep as read_streams() does, but only
+    compares the PMIDs of raw lines, so this costs a fraction of a full
+    conversion. Shards cover at most max_size bytes of the docs file
+    (but at least one document) and together the first limit documents,
+    if given. The last shard extends to the end of the tags file unless
+    limit stopped the scan. If start is given, the scan starts from that
+    Position.
+    """
+    shards = []
+    if start is None:
+        start = Position(0, 1, 0, 1)
+    with open(docfn, 'rb') as docf, open(tagfn, 'rb') as tagf:
+        doc_off, doc_ln, tag_off, tag_ln = start
+        docf.seek(doc_off)
+        tagf.seek(tag_off)
+        tag_line, total, count, limited = tagf.readline(), 0, 0, False
+        for doc_line in docf:
+            if limit is not None and total >= limit:
+                limited = True
+                break
+            id_ = doc_line.split(b'\t', 1)[0]
+            pmid = id_[5:] if id_.startswith(b'PMID:') else None
+            while tag_line:
+                if (tag_line.isspace() or tag_line[:1] == b'#' or
+                    tag_line.split(b'\t', 1)[0] == pmid):
+                    tag_off += len(tag_line)
+                    tag_ln += 1
+                    tag_line = tagf.readline()
+                else:
+                    break    # tagged for next document
+            doc_off += len(doc_line)
+            doc_ln += 1
+            total += 1
+            count += 1
+            if doc_off - start.doc_offset >= max_size:
+                end = Position(doc_off, doc_ln, tag_off, tag_ln)
+                shards.append(Shard(start, end, count))
+                start, count = end, 0
+        if count:
+            tag_end = tag_off if limited else None
+            end = Position(doc_off, doc_ln, tag_end, tag_ln)
+            shards.append(Shard(start, end, count))
+    return shards
+
+
 def type_name(type_):
     if isinstance(type_, str):
         type_ = int(type_)
@@ -226,26 +641,75 @@ def typename_and_species(type_):
         assert 'Unexpected type {}'.format(type_)
 
 
+def type_info(type_):
+    """Return typename_and_species(type_), resolving each type once."""
+    try:
+        return type_info.cache[type_]
+    except KeyError:
+        result = typename_and_species(type_)
+        if result is None:
+            raise FormatError('unexpected type {}'.format(type_))
+        type_info.cache[type_] = result
+        return result
+type_info.cache = {}
+
+
+TAXNAMES = 'data/taxnames.tsv'
+
+
+def read_taxid_names(fn):
+    """Return arrays of IDs and names in taxid-name TSV."""
+    print('loading taxid-name map from {} ... '.format(fn),
+          end='', file=sys.stderr, flush=True)
+    ids, names = array('q'), []
+    with open(fn) as f:
+        for line in f:
+            id_, name = line.rstrip('\n').split('\t')
+            ids.append(int(id_))
+            names.append(name)
+    print('done.', file=sys.stderr)
+    return ids, names
+
+
 def load_taxid_name_map(fn):
-    taxid_name_map = {}
+    """Return lookup table for taxid-name TSV, rebuilt when fn changes.
+
+    The table (see normdb.py) is stored next to fn with LUT_SUFFIX. If
+    the table cannot be written, the TSV is loaded into a dict. Returns
+    None if the TSV cannot be read.
+    """
+    tablefn = fn + LUT_SUFFIX
     try:
-        print('loading taxid-name map from {} ... '.format(fn),
-              end='', file=sys.stderr, flush=True)
-        with open(fn) as f:
-            for line in f:
-                id_, name = line.rstrip('\n').split('\t')
-                taxid_name_map[int(id_)] = name
-        print('done.', file=sys.stderr)
+        source = file_signature(fn)
     except Exception as e:
         error('failed to load {}: {}'.format(fn, e))
         return None
-    return taxid_name_map
+    try:
+        if os.path.exists(tablefn):
+            table = LookupTable(tablefn)
+            if table.source == source:
+                return table
+            table.close()
+    except Exception as e:
+        warning('failed to read {} for {}: {}'.format(tablefn, fn, e))
+    try:
+        ids, names = read_taxid_names(fn)
+    except Exception as e:
+        error('failed to load {}: {}'.format(fn, e))
+        return None
+    try:
+        write_lookup_table(tablefn, ids, names, source)
+        return LookupTable(tablefn)
+    except Exception as e:
+        warning('failed to write {}, reading {} into memory: {}'.format(
+            tablefn, fn, e))
+        return dict(zip(ids, names))
 
 
 def get_taxname(taxid):
     """Return scientific name for NCBI Taxonomy ID."""
     if get_taxname.id_name_map is None:
-        get_taxname.id_name_map = load_taxid_name_map('data/taxnames.tsv')
+        get_taxname.id_name_map = load_taxid_name_map(TAXNAMES)
         if get_taxname.id_name_map is None:    # assume fail, fallback
             get_taxname.id_name_map = TAXID_NAME_MAP
     return get_taxname.id_name_map.get(taxid, '<UNKNOWN>')
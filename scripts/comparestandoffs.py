@@ -10,11 +10,8 @@ from collections import defaultdict
 from itertools import chain
 from logging import info, warning, error
 
-try:
-    import sqlitedict
-except ImportError:
-    error('failed to import sqlitedict, try `pip3 install sqlitedict`')
-    raise
+from intervalindex import IntervalIndex
+from sinks import ArchiveReader, is_archive, read_standoff_db
 
 
 TYPE_MAP = {
@@ -213,21 +210,17 @@ def compare_annotations(ann1, ann2, options, stats, label):
 
     match1, only1 = set(), set()
     match2, only2 = set(), set()
+    index = IntervalIndex(ann2)
     for a1 in ann1:
         if not options.overlap:
-            a2m = [
-                a2 for a2 in ann2 if
-                a1.start == a2.start and
-                a1.end == a2.end and
-                types_match(a1.type, a2.type, a1.text, a2.text, options)
-            ]
+            candidates = index.same_span(a1.start, a1.end)
         else:
-            a2m = [
-                a2 for a2 in ann2 if
-                ((a1.start <= a2.start and a1.end >= a2.start) or
-                 (a1.start <= a2.end and a1.end >= a2.end)) and
-                types_match(a1.type, a2.type, a1.text, a2.text, options)
-            ]
+            # a2 shares an offset with a1, end offsets inclusive
+            candidates = index.intersecting(a1.start, a1.end)
+        a2m = [
+            ann2[i] for i in candidates if
+            types_match(a1.type, ann2[i].type, a1.text, ann2[i].text, options)
+        ]
         if a2m:
             print('MATCH: "{}" ({}/{})'.format(a1.text, a1.type, a2m[0].type))
             match1.add(a1)
@@ -282,15 +275,13 @@ def compare_files(file1, file2, options, stats):
 
 
 def compare_dbs(path1, path2, options, stats):
-    # No context manager and no close() as this is read-only and close()
-    # can block for a long time for no apparent reason.
-    db1 = sqlitedict.SqliteDict(path1, flag='r', autocommit=False)
-    db2 = sqlitedict.SqliteDict(path2, flag='r', autocommit=False)
-    for key, val1 in db1.items():
-        if os.path.splitext(key)[1] != options.suffix:
-            continue
-        val2 = db2.get(key)
-        if val2 is None:
+    # Merge join of the DBs in key order
+    items2 = read_standoff_db(path2, options.suffix)
+    key2, val2 = next(items2, (None, None))
+    for key, val1 in read_standoff_db(path1, options.suffix):
+        while key2 is not None and key2 < key:
+            key2, val2 = next(items2, (None, None))
+        if key2 != key:
             warning('{} not found in {}'.format(key, path2))
             continue
         ann1 = parse_standoff(val1, '{}/{}'.format(path1, key))
@@ -302,6 +293,61 @@ def compare_dbs(path1, path2, options, stats):
     return stats
 
 
+def compare_named(items1, get2, path1, path2, options, stats):
+    """Compare (name, content) items1 with get2(name) contents."""
+    for name, val1 in items1:
+        val2 = get2(name)
+        if val2 is None:
+            warning('{} not found in {}'.format(name, path2))
+            continue
+        ann1 = parse_standoff(val1, '{}/{}'.format(path1, name))
+        ann2 = parse_standoff(val2, '{}/{}'.format(path2, name))
+        stats = compare_annotations(ann1, ann2, options, stats, name)
+        if (options.limit is not None and
+            stats['doc-level']['TOTAL'] > options.limit):
+            return stats
+    return stats
+
+
+def compare_archives(path1, path2, options, stats):
+    with ArchiveReader(path1) as ar1, ArchiveReader(path2) as ar2:
+        return compare_named(ar1.items(options.suffix), ar2.get, path1,
+                             path2, options, stats)
+
+
+def directory_files(directory, suffix):
+    """Return {file name: path} for files with suffix in directory and
+    its subdirectories (see tagged2standoff.py -p)."""
+    files = {}
+    for root, dirs, fns in os.walk(directory):
+        dirs.sort()
+        for fn in sorted(fns):
+            if os.path.splitext(fn)[1] == suffix:
+                files.setdefault(fn, os.path.join(root, fn))
+    return files
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def compare_archive_dir(path1, path2, options, stats):
+    """Compare an archive with a directory, either way round, matching
+    archive members with files of the same name."""
+    archive, directory = (path1, path2) if is_archive(path1) else (path2,
+                                                                   path1)
+    files = directory_files(directory, options.suffix)
+    get_file = lambda name: read_file(files[name]) if name in files else None
+    with ArchiveReader(archive) as ar:
+        if archive == path1:
+            items1, get2 = ar.items(options.suffix), get_file
+        else:
+            items1 = ((name, read_file(files[name])) for name in sorted(files))
+            get2 = ar.get
+        return compare_named(items1, get2, path1, path2, options, stats)
+
+
 def compare_dirs(dir1, dir2, options, stats):
     assert os.path.isdir(dir1) and os.path.isdir(dir2)
     list1 = set(os.listdir(dir1))
@@ -329,7 +375,18 @@ def is_sqlite_db(path):
 def compare(path1, path2, options, stats=None):
     if stats is None:
         stats = defaultdict(lambda: defaultdict(int))
-    if is_sqlite_db(path1):
+    if is_archive(path1):
+        if is_archive(path2):
+            return compare_archives(path1, path2, options, stats)
+        elif os.path.isdir(path2):
+            return compare_archive_dir(path1, path2, options, stats)
+        elif not os.path.exists(path2):
+            warning('error: {} does not exist'.format(path2))
+            return stats
+        else:
+            warning('mismatch: {} is archive, {} is not'.format(path1, path2))
+            return stats
+    elif is_sqlite_db(path1):
         if is_sqlite_db(path2):
             return compare_dbs(path1, path2, options, stats)
         elif not os.path.exists(path2):
@@ -352,7 +409,9 @@ def compare(path1, path2, options, stats=None):
             warning('mismatch: {} is file, {} is not'.format(path1, path2))
             return stats
     elif os.path.isdir(path1):
-        if os.path.isdir(path2):
+        if is_archive(path2):
+            return compare_archive_dir(path1, path2, options, stats)
+        elif os.path.isdir(path2):
             return compare_dirs(path1, path2, options, stats)
         elif not os.path.exists(path2):
             warning('error: {} does not exist'.format(path2))
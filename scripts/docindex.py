@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Persistent byte-offset index for docs and tags TSV files keyed by
+# PMID. The index is stored next to the indexed file (FILE.idx) and
+# rebuilt automatically when the size or modification time of the
+# indexed file changes.
+
+import sys
+import os
+import mmap
+import struct
+
+from array import array
+from logging import info, warning
+
+from common import Document, Mention, MentionBatch, decode_line
+from fileio import is_plain_file, open_temporary
+
+
+INDEX_SUFFIX = '.idx'
+
+MAGIC = b'JLTSVIX1'
+
+# magic, indexed file size and mtime (ns), number of entries
+HEADER = struct.Struct('<8sQqQ')
+
+# PMID, byte offset, byte length and first line number of a run of
+# consecutive lines for the same PMID
+ENTRY = struct.Struct('<qQQQ')
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Index docs and tags files by PMID')
+    ap.add_argument('-o', '--output', metavar='PREFIX', default='subset',
+                    help='write PREFIX-docs.tsv and PREFIX-tags.tsv '
+                    'with the given PMIDs (default "subset")')
+    ap.add_argument('docs', help='tsv file with document text and data')
+    ap.add_argument('tags', help='tsv file with tags for documents')
+    ap.add_argument('pmids', metavar='PMID', nargs='*',
+                    help='documents to extract')
+    return ap
+
+
+def doc_pmid(line):
+    id_ = line.split(b'\t', 1)[0]
+    return id_[5:] if id_.startswith(b'PMID:') else None
+
+
+def tag_pmid(line):
+    return line.split(b'\t', 1)[0]
+
+
+def scan_runs(fn, get_pmid):
+    """Return arrays of PMID, offset, length and line number of runs."""
+    pmids, offsets, lengths, lines = (array('q'), array('Q'), array('Q'),
+                                      array('Q'))
+    current, offset = None, 0
+    with open(fn, 'rb') as f:
+        for ln, line in enumerate(f, start=1):
+            if line.isspace() or line[:1] == b'#':
+                current = None    # not part of any run
+            else:
+                pmid = get_pmid(line)
+                if pmid is not None and pmid == current:
+                    lengths[-1] += len(line)
+                else:
+                    current = pmid
+                    try:
+                        pmids.append(int(pmid))
+                        offsets.append(offset)
+                        lengths.append(len(line))
+                        lines.append(ln)
+                    except (TypeError, ValueError):
+                        warning('not indexing line {} in {}: no PMID'.format(
+                            ln, fn))
+                        current = None
+            offset += len(line)
+    return pmids, offsets, lengths, lines
+
+
+def build_index(fn, get_pmid, idxfn=None):
+    if idxfn is None:
+        idxfn = fn + INDEX_SUFFIX
+    print('indexing {} ... '.format(fn), end='', file=sys.stderr, flush=True)
+    stat = os.stat(fn)
+    pmids, offsets, lengths, lines = scan_runs(fn, get_pmid)
+    order = sorted(range(len(pmids)), key=pmids.__getitem__)    # stable
+    # unique temporary file as several processes may index the same file
+    out, tmpfn = open_temporary(idxfn)
+    with out:
+        out.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime_ns,
+                              len(order)))
+        for i in order:
+            out.write(ENTRY.pack(pmids[i], offsets[i], lengths[i], lines[i]))
+    os.replace(tmpfn, idxfn)
+    print('done ({} entries).'.format(len(order)), file=sys.stderr)
+    return idxfn
+
+
+class TsvIndex(object):
+    """Memory-mapped PMID index for a TSV file, see build_index()."""
+
+    def __init__(self, fn, get_pmid):
+        if not is_plain_file(fn):
+            raise ValueError('can only index uncompressed files: {}'.format(
+                fn))
+        self.fn = fn
+        self.idxfn = fn + INDEX_SUFFIX
+        if not self.is_current():
+            info('index {} missing or out of date'.format(self.idxfn))
+            build_index(fn, get_pmid, self.idxfn)
+        with open(self.idxfn, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = HEADER.unpack_from(self._mm)[3]
+
+    def is_current(self):
+        try:
+            with open(self.idxfn, 'rb') as f:
+                magic, size, mtime, _ = HEADER.unpack(f.read(HEADER.size))
+        except (OSError, struct.error):
+            return False
+        stat = os.stat(self.fn)
+        return (magic == MAGIC and size == stat.st_size and
+                mtime == stat.st_mtime_ns)
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self._mm, HEADER.size + i * ENTRY.size)
+
+    def _first(self, pmid):
+        # binary search for first entry with PMID >= pmid
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < pmid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def runs(self, pmid):
+        """Return (offset, length, line number) of runs for PMID."""
+        pmid, runs = int(pmid), []
+        for i in range(self._first(pmid), self.size):
+            entry = self.entry(i)
+            if entry[0] != pmid:
+                break
+            runs.append(entry[1:])
+        return runs
+
+    def pmids(self):
+        """Iterate over distinct PMIDs in ascending order."""
+        prev = None
+        for i in range(self.size):
+            pmid = self.entry(i)[0]
+            if pmid != prev:
+                yield pmid
+            prev = pmid
+
+    def __contains__(self, pmid):
+        i = self._first(int(pmid))
+        return i < self.size and self.entry(i)[0] == int(pmid)
+
+    def __len__(self):
+        return self.size
+
+    def read_lines(self, pmid):
+        """Return (line number, line) pairs for PMID."""
+        lines = []
+        with open(self.fn, 'rb') as f:
+            for offset, length, ln in self.runs(pmid):
+                f.seek(offset)
+                data = f.read(length)
+                for i, line in enumerate(data.split(b'\n'), start=ln):
+                    if line:
+                        lines.append((i, decode_line(line + b'\n')))
+        return lines
+
+    def close(self):
+        self._mm.close()
+
+
+class DocumentIndex(object):
+    """Random access to documents and mentions in docs and tags files."""
+
+    def __init__(self, docfn, tagfn):
+        self.docfn, self.tagfn = docfn, tagfn
+        self.docs = TsvIndex(docfn, doc_pmid)
+        self.tags = TsvIndex(tagfn, tag_pmid)
+
+    def get_document(self, pmid):
+        """Return Document for PMID or None if not found."""
+        lines = self.docs.read_lines(pmid)
+        if not lines:
+            return None
+        if len(lines) > 1:
+            warning('{} documents for PMID {} in {}, using first'.format(
+                len(lines), pmid, self.docfn))
+        ln, line = lines[0]
+        return Document.from_tsv(line, ln, self.docfn)
+
+    def get_mentions(self, pmid):
+        """Return MentionBatch for PMID."""
+        rows = []
+        for ln, line in self.tags.read_lines(pmid):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 8:
+                Mention.from_fields(fields, ln, self.tagfn)    # raises
+            rows.append(fields)
+        return MentionBatch.from_fields(rows)
+
+    def get(self, pmid):
+        """Return (document, mentions) for PMID as read_streams() does."""
+        document = self.get_document(pmid)
+        if document is None:
+            raise KeyError(pmid)
+        mentions = self.get_mentions(pmid)
+        mentions.validate_text(document.text)
+        return document, mentions
+
+    def pmids(self):
+        return self.docs.pmids()
+
+    def close(self):
+        self.docs.close()
+        self.tags.close()
+
+
+def extract(index, pmids, prefix):
+    docfn, tagfn = prefix + '-docs.tsv', prefix + '-tags.tsv'
+    with open(docfn, 'w', encoding='utf-8') as docf:
+        with open(tagfn, 'w', encoding='utf-8') as tagf:
+            for pmid in pmids:
+                doc_lines = index.docs.read_lines(pmid)
+                if not doc_lines:
+                    warning('PMID {} not found in {}'.format(
+                        pmid, index.docfn))
+                    continue
+                for ln, line in doc_lines:
+                    docf.write(line)
+                for ln, line in index.tags.read_lines(pmid):
+                    tagf.write(line)
+    print('Wrote {} and {}'.format(docfn, tagfn), file=sys.stderr)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    index = DocumentIndex(args.docs, args.tags)
+    print('{} document and {} tag entries'.format(
+        len(index.docs), len(index.tags)), file=sys.stderr)
+    if args.pmids:
+        extract(index, args.pmids, args.output)
+    index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
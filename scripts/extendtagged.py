@@ -10,8 +10,14 @@ from collections import defaultdict
 from logging import info, warning, error
 
 from standoff import Textbound, Normalization
-from common import read_streams
-from common import get_norm_name, get_norm_id, rewrite_norm_id
+from fileio import open_input
+from normdb import LookupTable, SqlTable, is_lookup_table, is_sql_table
+from checkpoint import file_signature
+from tagjoin import read_batches_unordered, DEFAULT_MEMORY
+from common import read_batches
+from common import resolve_mention
+from common import prefetch_norms, set_norm_cache_size, DEFAULT_CACHE_SIZE
+from common import report_norm_stats, load_norm_caches, save_norm_caches
 
 try:
     import sqlitedict
@@ -27,10 +33,27 @@ def argparser():
                     help='include entity names in output')
     ap.add_argument('-w', '--words', metavar='NUM', default=None, type=int,
                     help='number of context words to include')
+    ap.add_argument('-R', '--resolution', metavar='TABLE', default=None,
+                    help='resolution table (run combinedicts.py -R)')
     ap.add_argument('-l', '--limit', type=int, metavar='INT', default=None,
                     help='maximum number of documents to convert')
-    ap.add_argument('docs', help='tsv file with document text and data')
-    ap.add_argument('tags', help='tsv file with tags for documents')
+    ap.add_argument('-c', '--cache-size', metavar='INT', type=int,
+                    default=DEFAULT_CACHE_SIZE,
+                    help='maximum number of cached DB values (default {})'.\
+                    format(DEFAULT_CACHE_SIZE))
+    ap.add_argument('--cache-file', metavar='FILE', default=None,
+                    help='load DB value cache from FILE and save it there '
+                    'after the run')
+    ap.add_argument('-u', '--unordered', default=False, action='store_true',
+                    help='tags are not in the same order as documents')
+    ap.add_argument('-M', '--memory', metavar='MB', type=int,
+                    default=DEFAULT_MEMORY//2**20,
+                    help='memory budget for --unordered tags (default {})'.\
+                    format(DEFAULT_MEMORY//2**20))
+    ap.add_argument('docs', help='tsv file with document text and data '
+                    '(may be compressed, "-" for STDIN)')
+    ap.add_argument('tags', help='tsv file with tags for documents '
+                    '(may be compressed, "-" for STDIN)')
     ap.add_argument('entitydb', help='DB mapping tagger IDs to external IDs')
     ap.add_argument('namedb', help='DB mapping tagger IDs to names')
     return ap
@@ -54,53 +77,74 @@ def get_words(text, maximum, reverse=False):
 
 
 def output(document, mentions, options):
-    for m in mentions:
-        norm_name = get_norm_name(m.serial, m.text, options)
-        # if we have a species name, add it to the norm text
-        if m.species:
-            norm_name = norm_name + ' ({})'.format(m.species)
-        norm_id = get_norm_id(m.serial, 'TAGGER:{}'.format(m.serial), options)
-        norm_id = rewrite_norm_id(norm_id, m.typename, m.species)
+    """Output MentionBatch for document."""
+    for i, (para, sent, start, end, text, type_, serial) in enumerate(zip(
+            mentions.para, mentions.sent, mentions.start, mentions.end,
+            mentions.text, mentions.type, mentions.serial)):
+        typename, norm_id, norm_name = resolve_mention(serial, type_, text,
+                                                       options)
         # NOTE: end-1 to revert exclusive to inclusive (see Mention.__init__)
-        fields = [m.pmid, m.para, m.sent, m.start, m.end-1, m.text,
-                  m.typename, norm_id]
+        fields = [document.pmid, para, sent, start, end-1, text,
+                  typename, norm_id]
         if options.names:
             fields.append(norm_name)
         if options.words is not None:
             doctext = document.text
-            before = get_words(doctext[:m.start], options.words, reverse=True)
-            after = get_words(doctext[m.end:], options.words, reverse=False)
-            fields.append('{}<<<{}>>>{}'.format(before, m.text, after))
+            before = get_words(doctext[:start], options.words, reverse=True)
+            after = get_words(doctext[end:], options.words, reverse=False)
+            fields.append('{}<<<{}>>>{}'.format(before, text, after))
         print('\t'.join(str(i) for i in fields))
 
 
+def reader(docf, tagf, options):
+    if options.unordered:
+        return read_batches_unordered(docf, tagf, limit=options.limit or None,
+                                      memory=options.memory*2**20)
+    else:
+        return read_batches(docf, tagf, limit=options.limit or None)
+
+
 def process(docfn, tagfn, options):
     count = 0
-    with open(docfn, encoding='utf-8') as docf:
-        with open(tagfn, encoding='utf-8') as tagf:
-            for document, mentions in read_streams(docf, tagf):
-                if options.limit and count >= options.limit:
-                    break
-                output(document, mentions, options)
-                count += 1
-                if count % 1024 == 0:
-                    print('Processed {} ...'.format(count), end='\r',
-                          file=sys.stderr, flush=True)
+    with open_input(docfn) as docf:
+        with open_input(tagfn) as tagf:
+            for batch in reader(docf, tagf, options):
+                prefetch_norms(batch, options)
+                for document, mentions in batch:
+                    output(document, mentions, options)
+                    count += 1
+                    if count % 1024 == 0:
+                        print('Processed {} ...'.format(count), end='\r',
+                              file=sys.stderr, flush=True)
     print('Done, processed {} documents.'.format(count), file=sys.stderr)
+    report_norm_stats(options)
     return count
 
 
 def open_db(fn, flag='r'):
     if not os.path.exists(fn):
         raise IOError("no such file: '{}'".format(fn))
+    if is_lookup_table(fn):
+        return LookupTable(fn)
+    if is_sql_table(fn):
+        return SqlTable(fn)
     return sqlitedict.SqliteDict(fn, flag=flag)
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
+    sources = [file_signature(fn) if fn is not None else None
+               for fn in (args.entitydb, args.namedb, args.resolution)]
+    if args.resolution is not None:
+        args.resolution = LookupTable(args.resolution)
     args.entitydb = open_db(args.entitydb)
     args.namedb = open_db(args.namedb)
+    set_norm_cache_size(args.cache_size)
+    if args.cache_file:
+        load_norm_caches(args.cache_file, sources)
     count = process(args.docs, args.tags, args)
+    if args.cache_file:
+        save_norm_caches(args.cache_file, sources)
     return 0
 
 
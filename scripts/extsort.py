@@ -0,0 +1,106 @@
+# External merge sort of text lines under a memory budget.
+
+import os
+import heapq
+import shutil
+import tempfile
+
+
+DEFAULT_MEMORY = 2**30
+
+# Approximate memory use of a line in addition to its length
+LINE_OVERHEAD = 100
+
+# Minimum size of a run, so that a small budget does not spill a run
+# per line
+MIN_RUN_SIZE = 2**20
+
+# Maximum number of runs merged at a time (open files)
+MAX_MERGE_RUNS = 64
+
+
+class ExternalSorter(object):
+    """Stable sort of text lines by key, spilling sorted runs to disk.
+
+    Lines must end in newline. Lines are kept in memory until their
+    approximate size exceeds memory bytes (at least MIN_RUN_SIZE), after
+    which they are sorted and written to a temporary file (run).
+    Iteration merges the runs, in several passes if there are more than
+    MAX_MERGE_RUNS.
+    """
+
+    def __init__(self, key, memory=DEFAULT_MEMORY, tmpdir=None):
+        self.key = key
+        self.memory = max(memory, MIN_RUN_SIZE)
+        self.tmpdir = tmpdir
+        self._lines, self._size, self._runs = [], 0, []
+        self._rundir, self._count, self._open = None, 0, []
+
+    def add(self, line):
+        self._lines.append(line)
+        self._size += len(line) + LINE_OVERHEAD
+        if self._size >= self.memory:
+            self._spill()
+
+    def extend(self, lines):
+        for line in lines:
+            self.add(line)
+
+    def _new_run(self, lines):
+        if self._rundir is None:
+            self._rundir = tempfile.mkdtemp(prefix='extsort-',
+                                            dir=self.tmpdir)
+        fn = os.path.join(self._rundir, 'run-{}'.format(self._count))
+        self._count += 1
+        with open(fn, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        return fn
+
+    def _open_runs(self, runs):
+        return [open(fn, encoding='utf-8') for fn in runs]
+
+    def _spill(self):
+        self._lines.sort(key=self.key)
+        self._runs.append(self._new_run(self._lines))
+        self._lines, self._size = [], 0
+
+    def _merge_pass(self):
+        # merging consecutive runs keeps the order of equal lines
+        merged = []
+        for i in range(0, len(self._runs), MAX_MERGE_RUNS):
+            runs = self._runs[i:i+MAX_MERGE_RUNS]
+            files = self._open_runs(runs)
+            merged.append(self._new_run(heapq.merge(*files, key=self.key)))
+            for f in files:
+                f.close()
+            for fn in runs:
+                os.remove(fn)
+        self._runs = merged
+
+    @property
+    def spilled(self):
+        return len(self._runs)
+
+    def __iter__(self):
+        self._lines.sort(key=self.key)
+        if not self._runs:
+            return iter(self._lines)
+        while len(self._runs) > MAX_MERGE_RUNS:
+            self._merge_pass()
+        self._open = self._open_runs(self._runs)
+        # heapq.merge() keeps the order of equal lines across runs
+        return heapq.merge(*self._open, self._lines, key=self.key)
+
+    def close(self):
+        for f in self._open:
+            f.close()
+        if self._rundir is not None:
+            shutil.rmtree(self._rundir, ignore_errors=True)
+        self._lines, self._size, self._runs = [], 0, []
+        self._rundir, self._count, self._open = None, 0, []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,228 @@
+import sys
+import os
+import io
+import bz2
+import gzip
+import lzma
+import queue
+import tempfile
+import threading
+
+from logging import error
+
+
+# Magic bytes of supported compression formats
+MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+# Size of decompressed chunks and maximum number of chunks buffered
+# by the background decompression thread
+CHUNK_SIZE = 2**20
+
+QUEUE_SIZE = 16
+
+STDIN = '-'
+
+STDOUT = '-'
+
+# Output compression by file name suffix
+OUTPUT_COMPRESSION = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+GZIP_LEVEL = 6
+
+
+class BackgroundReader(io.RawIOBase):
+    """Read file object in a background thread through a bounded queue.
+
+    Used for decompression, which releases the GIL, so that
+    decompression and parsing can run on different cores.
+    """
+
+    def __init__(self, f, name, chunk_size=CHUNK_SIZE, queue_size=QUEUE_SIZE):
+        super().__init__()
+        self.name = name
+        self._f = f
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(queue_size)
+        self._chunk, self._pos = memoryview(b''), 0
+        self._eof = False
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._closing.is_set():
+                chunk = self._f.read(self._chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closing.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._pos >= len(self._chunk):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            elif not item:
+                self._eof = True
+                return 0
+            self._chunk, self._pos = memoryview(item), 0
+        n = min(len(b), len(self._chunk) - self._pos)
+        b[:n] = self._chunk[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._closing.set()
+            self._thread.join()
+            self._f.close()
+        super().close()
+
+
+def detect_compression(f):
+    """Return compression format of binary file object or None."""
+    head = f.peek(8)[:8]
+    for magic, format_ in MAGIC:
+        if head.startswith(magic):
+            return format_
+    return None
+
+
+def input_compression(fn):
+    """Return compression format of file or None if not compressed."""
+    with open(fn, 'rb') as f:
+        return detect_compression(f)
+
+
+def is_plain_file(fn):
+    """Return True if fn is an uncompressed file (not STDIN)."""
+    return fn != STDIN and input_compression(fn) is None
+
+
+def decompressor(f, format_):
+    if format_ == 'gzip':
+        return gzip.GzipFile(fileobj=f)
+    elif format_ == 'bz2':
+        return bz2.BZ2File(f)
+    elif format_ == 'xz':
+        return lzma.LZMAFile(f)
+    elif format_ == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            error('failed to import zstandard; try `pip3 install zstandard`')
+            raise
+        return zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True)
+    else:
+        raise ValueError(format_)
+
+
+def skip_input(f, size):
+    """Skip size bytes of binary file object, seeking if possible."""
+    if f.seekable():
+        f.seek(size, io.SEEK_CUR)
+        return
+    while size > 0:
+        data = f.read(min(size, CHUNK_SIZE))
+        if not data:
+            raise EOFError('unexpected end of {}'.format(f.name))
+        size -= len(data)
+
+
+def open_temporary(fn, mode='wb'):
+    """Return (file, name) of a new uniquely named file in the directory
+    of fn, to be renamed to fn with os.replace() when complete.
+
+    Unlike tempfile.mkstemp(), the file gets the permissions of a file
+    created with open().
+    """
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)),
+                                 prefix=os.path.basename(fn) + '.',
+                                 suffix='.tmp')
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(fd, 0o666 & ~umask)
+    return open(fd, mode), tmpfn
+
+
+def open_input(fn, mode='rt', encoding='utf-8'):
+    """Open file or STDIN ('-') for reading, decompressing if compressed.
+
+    Compression is detected from magic bytes. Compressed input is
+    decompressed by a BackgroundReader.
+    """
+    if mode not in ('r', 'rt', 'rb'):
+        raise ValueError('invalid mode: {}'.format(mode))
+    if fn == STDIN:
+        f, name = sys.stdin.buffer, '<stdin>'
+    else:
+        f, name = open(fn, 'rb'), fn
+    format_ = detect_compression(f)
+    if format_ is not None:
+        f = io.BufferedReader(BackgroundReader(decompressor(f, format_), name),
+                              CHUNK_SIZE)
+    if mode == 'rb':
+        return f
+    else:
+        return io.TextIOWrapper(f, encoding=encoding)
+
+
+def output_compression(fn):
+    """Return compression format for output file name or None."""
+    if fn == STDOUT:
+        return None
+    return OUTPUT_COMPRESSION.get(os.path.splitext(fn)[1])
+
+
+def open_output(fn):
+    """Open file or STDOUT ('-') for writing in binary mode, compressing
+    if the file name has a compression suffix (see OUTPUT_COMPRESSION).
+
+    STDOUT is not closed when the returned file object is closed.
+    """
+    format_ = output_compression(fn)
+    if fn == STDOUT:
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), 'wb', closefd=False)
+    elif format_ == 'gzip':
+        return gzip.open(fn, 'wb', compresslevel=GZIP_LEVEL)
+    elif format_ == 'bz2':
+        return bz2.open(fn, 'wb')
+    elif format_ == 'xz':
+        return lzma.open(fn, 'wb')
+    elif format_ == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            error('failed to import zstandard; try `pip3 install zstandard`')
+            raise
+        return zstandard.ZstdCompressor().stream_writer(open(fn, 'wb'))
+    else:
+        return open(fn, 'wb')
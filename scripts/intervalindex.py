@@ -0,0 +1,140 @@
+# Static index of intervals for overlap, containment and crossing
+# queries.
+#
+# Intervals are objects with integer start and end offsets, such as
+# the Textbounds of standoff.py and comparestandoffs.py, with end
+# exclusive. The index keeps two range trees: intervals sorted by
+# start with the minimum and maximum end of each subtree, and sorted
+# by end with the minimum and maximum start. A query selects a range
+# of one coordinate by binary search and bounds the other by pruning
+# subtrees. When that bound is one-sided, every visited subtree holds
+# a result, so the query takes O(log n) time per result (and O(log n)
+# with none). The overlap, intersection, containment and crossing
+# queries below only use such bounds.
+
+from bisect import bisect_left, bisect_right
+
+
+INF = float('inf')
+
+
+class RangeTree(object):
+    """Items sorted by key under a segment tree of the minimum and
+    maximum value of each subtree."""
+
+    def __init__(self, keys, values):
+        n = len(keys)
+        self.order = sorted(range(n), key=keys.__getitem__)
+        self.keys = [keys[i] for i in self.order]
+        self.values = [values[i] for i in self.order]
+        self.min_value = [0] * (4*n)
+        self.max_value = [0] * (4*n)
+        if n:
+            self._build(1, 0, n)
+
+    def _build(self, node, lo, hi):
+        if hi - lo == 1:
+            self.min_value[node] = self.max_value[node] = self.values[lo]
+            return
+        mid = (lo + hi) // 2
+        self._build(2*node, lo, mid)
+        self._build(2*node+1, mid, hi)
+        self.min_value[node] = min(self.min_value[2*node],
+                                   self.min_value[2*node+1])
+        self.max_value[node] = max(self.max_value[2*node],
+                                   self.max_value[2*node+1])
+
+    def _search(self, i, j, value_lo, value_hi, node, lo, hi, found):
+        # positions in [i, j) under node with value in [value_lo, value_hi]
+        if (hi <= i or j <= lo or self.max_value[node] < value_lo or
+            self.min_value[node] > value_hi):
+            return
+        if hi - lo == 1:
+            found.append(self.order[lo])
+            return
+        mid = (lo + hi) // 2
+        self._search(i, j, value_lo, value_hi, 2*node, lo, mid, found)
+        self._search(i, j, value_lo, value_hi, 2*node+1, mid, hi, found)
+
+    def query(self, key_lo, key_hi, value_lo, value_hi):
+        """Return unordered indices of items with key in [key_lo, key_hi]
+        and value in [value_lo, value_hi]."""
+        i = bisect_left(self.keys, key_lo)
+        j = bisect_right(self.keys, key_hi)
+        found = []
+        if i < j:
+            self._search(i, j, value_lo, value_hi, 1, 0, len(self.keys),
+                         found)
+        return found
+
+
+class IntervalIndex(object):
+    """Index of a sequence of intervals.
+
+    Queries return indices into the sequence in increasing order.
+    """
+
+    def __init__(self, intervals):
+        self.intervals = intervals
+        starts = [interval.start for interval in intervals]
+        ends = [interval.end for interval in intervals]
+        self._by_start = RangeTree(starts, ends)
+        self._by_end = RangeTree(ends, starts)
+        self.by_span = {}
+        for i, interval in enumerate(intervals):
+            self.by_span.setdefault((interval.start, interval.end), []).\
+                append(i)
+
+    def query(self, start_lo=-INF, start_hi=INF, end_lo=-INF, end_hi=INF):
+        """Return indices of intervals with start in [start_lo, start_hi]
+        and end in [end_lo, end_hi].
+
+        O(log n) per result if at most one of end_lo and end_hi is given;
+        otherwise pruning on end does not bound the time.
+        """
+        return sorted(self._by_start.query(start_lo, start_hi, end_lo,
+                                           end_hi))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def same_span(self, start, end):
+        """Return indices of intervals with the given span."""
+        return self.by_span.get((start, end), [])
+
+    def overlapping(self, start, end):
+        """Return indices of intervals sharing an offset with [start, end)."""
+        return self.query(start_hi=end-1, end_lo=start+1)
+
+    def intersecting(self, start, end):
+        """Return indices of intervals sharing an offset with the closed
+        span [start, end], i.e. overlapping or touching [start, end)."""
+        return self.query(start_hi=end, end_lo=start)
+
+    def containing(self, start, end):
+        """Return indices of intervals containing [start, end), including
+        those with the same span."""
+        return self.query(start_hi=start, end_lo=end)
+
+    def contained(self, start, end):
+        """Return indices of intervals within [start, end), including
+        those with the same span."""
+        return self.query(start_lo=start, end_hi=end)
+
+    def crossing(self, start, end):
+        """Return indices of intervals overlapping [start, end) where
+        neither contains the other."""
+        # ending inside: end range on the tree by end, start bounded above
+        left = self._by_end.query(start+1, end-1, -INF, start-1)
+        # starting inside: start range on the tree by start, end below
+        right = self._by_start.query(start+1, end-1, end+1, INF)
+        return sorted(left + right)
+
+    def overlapping_pairs(self):
+        """Yield (i, j) index pairs of overlapping intervals, i < j,
+        ordered by j and then i."""
+        for j, interval in enumerate(self.intervals):
+            for i in self.overlapping(interval.start, interval.end):
+                if i >= j:
+                    break
+                yield i, j
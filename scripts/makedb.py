@@ -2,8 +2,19 @@
 
 import sys
 import os
+import time
 
-from logging import error
+from array import array
+from bisect import bisect_left
+from functools import partial
+from logging import error, warning
+
+from fileio import open_input, skip_input, is_plain_file, STDIN
+from checkpoint import save_checkpoint, load_checkpoint, file_signature
+from checkpoint import reset_checkpoint_log, append_checkpoint_log
+from checkpoint import read_checkpoint_log
+from normdb import write_lookup_table, SqlTableWriter, LUT_SUFFIX
+from chunkparse import map_chunks
 
 try:
     import sqlitedict
@@ -16,68 +27,249 @@ DEFAULT_INTERVAL = 10**6
 
 DEFAULT_MAXERR = 100
 
+# Approximate size of input parsed and stored at a time by read_chunks()
+READ_CHUNK = 2**22
+
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
     ap.add_argument('-f', '--value-field', metavar='INT', type=int, default=2,
                     help='TSV column containing values (default 2)')
+    ap.add_argument('-a', '--all-fields', default=False, action='store_true',
+                    help='use all fields after key as value')
+    ap.add_argument('-F', '--format', choices=('sqlite', 'sql', 'lut'),
+                    default=None,
+                    help='output sqlitedict DB, plain SQL table or '
+                    'memory-mapped lookup table (default lut if dbname '
+                    'ends with {}, else sqlite)'.format(LUT_SUFFIX))
     ap.add_argument('-i', '--commit-interval', metavar='INT', type=int,
                     default=DEFAULT_INTERVAL,
                     help='number of items to input between commits')
     ap.add_argument('-e', '--max-errors', metavar='INT', type=int,
                     default=DEFAULT_MAXERR,
                     help='maximum number of errors to ignore')
-    ap.add_argument('dict', help='input dictionary in key-value TSV format')
+    ap.add_argument('-w', '--workers', type=int, metavar='INT', default=None,
+                    help='number of parsing processes (-F sql or lut, '
+                    'uncompressed input)')
+    ap.add_argument('-r', '--resume', default=False, action='store_true',
+                    help='resume from last checkpoint')
+    ap.add_argument('dict', help='input dictionary in key-value TSV format '
+                    '(may be compressed, "-" for STDIN)')
     ap.add_argument('dbname', help='output database name')
     return ap
 
 
+def progress(ln, limit):
+    if limit is None:    # unknown
+        return 'Read {} lines'.format(ln)
+    else:
+        return 'Read {}/{} ({:.1%}) lines'.format(ln, limit, ln/limit)
+
+
+def parse_line(line, value_index, options):
+    fields = line.rstrip('\n').split('\t')
+    if options.all_fields:
+        return int(fields[0]), '\t'.join(fields[1:])
+    else:
+        return int(fields[0]), fields[value_index]
+
+
+def report_error(ln, fn, e, options):
+    error('on line {} in {} (skip): {}'.format(ln, fn, e))
+    options.max_errors -= 1
+    if options.max_errors <= 0:
+        raise RuntimeError('max-errors exceeded, aborting.')
+
+
+class KeyBitmap(object):
+    """Set of integer keys stored in pages of 2**PAGE_SHIFT keys.
+
+    A page with one key holds its offset, and a page with more a sorted
+    array of offsets until it reaches MAX_SPARSE keys and is replaced by
+    a bitmap with one bit per key in its range. Dense keys such as
+    dictionary serials thus take about range/8 bytes, and sparse keys
+    (one per page) about twice as much as in a set. Pages changed since
+    the last call to take_dirty() are tracked for incremental
+    checkpoints.
+    """
+
+    PAGE_SHIFT = 16
+
+    # Sparse pages are at most the size of a bitmap (2-byte offsets)
+    MAX_SPARSE = 1 << (PAGE_SHIFT-4)
+
+    def __init__(self, pages=None):
+        self.pages = pages if pages is not None else {}
+        self.count = sum(self._page_count(page)
+                         for page in self.pages.values())
+        self.dirty = set()
+
+    @staticmethod
+    def _page_count(page):
+        if isinstance(page, int):
+            return 1
+        elif isinstance(page, array):
+            return len(page)
+        return bin(int.from_bytes(page, 'little')).count('1')
+
+    def _to_bitmap(self, page):
+        bitmap = bytearray(1<<(self.PAGE_SHIFT-3))
+        for bit in page:
+            bitmap[bit >> 3] |= 1 << (bit & 7)
+        return bitmap
+
+    def add(self, key):
+        page_idx, bit = key >> self.PAGE_SHIFT, key & ((1<<self.PAGE_SHIFT)-1)
+        page = self.pages.get(page_idx)
+        if page is None:
+            self.pages[page_idx] = bit
+        elif isinstance(page, int):
+            if page == bit:
+                return
+            self.pages[page_idx] = array('H', sorted((page, bit)))
+        elif isinstance(page, array):
+            i = bisect_left(page, bit)
+            if i < len(page) and page[i] == bit:
+                return
+            if len(page) < self.MAX_SPARSE:
+                page.insert(i, bit)
+            else:
+                page = self.pages[page_idx] = self._to_bitmap(page)
+                page[bit >> 3] |= 1 << (bit & 7)
+        else:
+            mask = 1 << (bit & 7)
+            if page[bit >> 3] & mask:
+                return
+            page[bit >> 3] |= mask
+        self.count += 1
+        self.dirty.add(page_idx)
+
+    def __contains__(self, key):
+        page = self.pages.get(key >> self.PAGE_SHIFT)
+        if page is None:
+            return False
+        bit = key & ((1<<self.PAGE_SHIFT)-1)
+        if isinstance(page, int):
+            return page == bit
+        elif isinstance(page, array):
+            i = bisect_left(page, bit)
+            return i < len(page) and page[i] == bit
+        return bool(page[bit >> 3] & (1 << (bit & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def take_dirty(self):
+        """Return {page index: page copy} of pages changed since last
+        call."""
+        pages = self.pages
+        dirty = {i: pages[i] if isinstance(pages[i], int) else pages[i][:]
+                 for i in self.dirty}
+        self.dirty = set()
+        return dirty
+
+    @classmethod
+    def from_updates(cls, updates):
+        """Return KeyBitmap from take_dirty() results in order."""
+        pages = {}
+        for dirty in updates:
+            pages.update(dirty)
+        return cls(pages)
+
+
 def process_interval(in_, dbname, idx, end, limit, options):
     value_index = options.value_field-1    # 1-based to 0-based
     seen_keys = process_interval.seen_keys
-    end = min(end, limit)
+    if limit is not None:
+        end = min(end, limit)
+    ln = idx
     with sqlitedict.SqliteDict(dbname, autocommit=False) as db:
         while idx < end:
             ln = idx + 1
             try:
                 line = next(in_)
             except StopIteration:
-                error('unexpected EOF in {} at line {}'.format(in_.name, ln))
+                if limit is not None:
+                    error('unexpected EOF in {} at line {}'.format(
+                        in_.name, ln))
                 break
+            process_interval.offset += len(line)
             try:
                 line = line.decode('utf-8')
-                fields = line.rstrip('\n').split('\t')
-                key, value = fields[0], fields[value_index]
-                key = int(key)
+                key, value = parse_line(line, value_index, options)
                 if key not in seen_keys:    # only add first
                     db[key] = value
                     seen_keys.add(key)
             except Exception as e:
-                error('on line {} in {} (skip): {}'.format(ln, in_.name, e))
-                options.max_errors -= 1
-                if options.max_errors <= 0:
-                    raise RuntimeError('max-errors exceeded, aborting.')
+                report_error(ln, in_.name, e, options)
             if ln % 1024 == 0:
-                print('Read {}/{} ({:.1%}) lines'.format(ln, limit, ln/limit),
-                      end='\r', file=sys.stderr, flush=True)
+                print(progress(ln, limit), end='\r', file=sys.stderr,
+                      flush=True)
             idx += 1
-        print('Read {}/{} ({:.1%}) lines, committing...'.format(
-            ln, limit, ln/limit), end='', file=sys.stderr, flush=True)
+        print('{}, committing...'.format(progress(idx, limit)), end='',
+              file=sys.stderr, flush=True)
         db.commit()
+        # only the key pages changed in this interval are logged
+        log_size = append_checkpoint_log(dbname, seen_keys.take_dirty())
+        save_checkpoint(dbname, checkpoint_state(idx, log_size, options))
         print('done.', file=sys.stderr)
     return idx
-process_interval.seen_keys = set()
+process_interval.seen_keys = KeyBitmap()
+process_interval.offset = 0    # bytes read from input
+
+
+def checkpoint_state(idx, log_size, options):
+    if options.dict == STDIN:
+        signature = None
+    else:
+        signature = file_signature(options.dict)
+    return {
+        'dict': signature,
+        'value_field': options.value_field,
+        'all_fields': options.all_fields,
+        'lines': idx,
+        'offset': process_interval.offset,
+        'log_size': log_size,    # of seen key pages
+    }
+
+
+def resume(in_, options):
+    """Restore state from checkpoint, skip input and return line index."""
+    state = load_checkpoint(options.dbname)
+    if state is None:
+        warning('no checkpoint for {}, starting from beginning'.format(
+            options.dbname))
+        return 0
+    if (state['value_field'] != options.value_field or
+        state['all_fields'] != options.all_fields or
+        (options.dict != STDIN and
+         state['dict'] != file_signature(options.dict))):
+        raise ValueError('input or options changed since checkpoint for '
+                         '{}'.format(options.dbname))
+    print('Resuming after {} lines.'.format(state['lines']), file=sys.stderr)
+    skip_input(in_, state['offset'])
+    process_interval.offset = state['offset']
+    process_interval.seen_keys = KeyBitmap.from_updates(
+        read_checkpoint_log(options.dbname, state['log_size']))
+    return state['lines']
 
 
 def process(in_, dbname, total_lines, options):
     print('Reading from {} ...'.format(in_.name), file=sys.stderr)
     idx, interval = 0, options.commit_interval
-    while idx < total_lines:
+    if options.resume:
+        idx = resume(in_, options)
+    if idx == 0:
+        reset_checkpoint_log(dbname)
+    while total_lines is None or idx < total_lines:
         nxt = process_interval(in_, dbname, idx, idx+interval, total_lines,
                                options)
         if nxt == idx:
             break    # failed to progress
+        elif total_lines is None and nxt < idx+interval:
+            idx = nxt
+            break    # EOF
         idx = nxt
     unique = len(process_interval.seen_keys)
     ratio = 0 if idx == 0 else unique/idx
@@ -85,17 +277,109 @@ def process(in_, dbname, total_lines, options):
         idx, unique, ratio, file=sys.stderr))
 
 
+def parse_lines(lines, options):
+    """Parse chunk of lines, return compact (count, keys, values, errors).
+
+    Run in worker processes with --workers; errors are (index, message)
+    pairs reported by the caller.
+    """
+    value_index = options.value_field-1    # 1-based to 0-based
+    keys, values, errors = array('q'), [], []
+    for i, line in enumerate(lines):
+        try:
+            key, value = parse_line(line.decode('utf-8'), value_index, options)
+            keys.append(key)
+            values.append(value)
+        except Exception as e:
+            errors.append((i, str(e)))
+    return len(lines), keys, values, errors
+
+
+def read_chunks(in_, options):
+    """Yield (lines read, keys, values) for chunks of input in order."""
+    if options.workers is not None and options.workers > 1:
+        results = map_chunks(options.dict, partial(parse_lines,
+                                                   options=options),
+                             options.workers)
+    else:
+        chunks = iter(lambda: in_.readlines(READ_CHUNK), [])
+        results = (parse_lines(lines, options) for lines in chunks)
+    ln = 0
+    for count, keys, values, errors in results:
+        for i, message in errors:
+            report_error(ln+i+1, in_.name, message, options)
+        ln += count
+        yield ln, keys, values
+
+
+def process_table(in_, dbname, options):
+    """Read all of input and write lookup table (see normdb.py)."""
+    print('Reading from {} ...'.format(in_.name), file=sys.stderr)
+    keys, values = array('q'), []
+    ln = 0
+    for ln, chunk_keys, chunk_values in read_chunks(in_, options):
+        keys.extend(chunk_keys)
+        values.extend(chunk_values)
+        print(progress(ln, None), end='\r', file=sys.stderr, flush=True)
+    print('{}, writing...'.format(progress(ln, None)), end='',
+          file=sys.stderr, flush=True)
+    source = None if options.dict == STDIN else file_signature(options.dict)
+    unique = write_lookup_table(dbname, keys, values, source)
+    print('done.', file=sys.stderr)
+    ratio = 0 if ln == 0 else unique/ln
+    print('Finished: read {}, stored {} unique ({:.1%}).'.format(
+        ln, unique, ratio), file=sys.stderr)
+
+
+def process_sql(in_, dbname, options):
+    """Read all of input and bulk load into plain SQL table."""
+    print('Reading from {} ...'.format(in_.name), file=sys.stderr)
+    db = SqlTableWriter(dbname)
+    ln, unique, start = 0, 0, time.time()
+    for ln, keys, values in read_chunks(in_, options):
+        unique += db.insert(zip(keys, values))
+        print(progress(ln, None), end='\r', file=sys.stderr, flush=True)
+    print('{}, committing...'.format(progress(ln, None)), end='',
+          file=sys.stderr, flush=True)
+    db.close()
+    print('done.', file=sys.stderr)
+    elapsed = time.time() - start
+    ratio = 0 if ln == 0 else unique/ln
+    print('Finished: read {}, stored {} unique ({:.1%}) in {:.1f}s '
+          '({:.0f} rows/s).'.format(ln, unique, ratio, elapsed,
+                                    ln/elapsed if elapsed else 0),
+          file=sys.stderr)
+
+
 def count_lines(fn):
-    return sum(1 for l in open(fn, 'rb'))
+    with open_input(fn, 'rb') as f:
+        return sum(1 for l in f)
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
     if args.value_field < 2:
         raise ValueError('--value_field must be 2 or greater')
-    line_count = count_lines(args.dict)
-    with open(args.dict, 'rb') as in_:
-        process(in_, args.dbname, line_count, args)
+    if args.format is None:
+        args.format = 'lut' if args.dbname.endswith(LUT_SUFFIX) else 'sqlite'
+    if args.resume and args.format != 'sqlite':
+        error('--resume is only supported for sqlite output')
+        return 1
+    if (args.workers is not None and args.workers > 1 and
+        (args.format == 'sqlite' or not is_plain_file(args.dict))):
+        error('--workers requires -F sql or lut and an uncompressed file')
+        return 1
+    if args.format == 'sqlite' and args.dict != STDIN:
+        line_count = count_lines(args.dict)
+    else:
+        line_count = None    # single pass
+    with open_input(args.dict, 'rb') as in_:
+        if args.format == 'lut':
+            process_table(in_, args.dbname, args)
+        elif args.format == 'sql':
+            process_sql(in_, args.dbname, args)
+        else:
+            process(in_, args.dbname, line_count, args)
     return 0
 
 
@@ -0,0 +1,120 @@
+# Manifest of converted documents for incremental conversion.
+
+import sqlite3
+import hashlib
+
+from logging import info
+
+
+# Increment when the digest or conversion output format changes
+MANIFEST_VERSION = 1
+
+ADDED, CHANGED, REMOVED = 'added', 'changed', 'removed'
+
+
+def document_digest(document, mentions, salt):
+    """Return digest of document text and MentionBatch columns."""
+    h = hashlib.blake2b(salt, digest_size=16)
+    h.update(str(document).encode('utf-8'))
+    for column in (mentions.para, mentions.sent, mentions.start, mentions.end,
+                   mentions.type, mentions.serial):
+        h.update(column.tobytes())
+    h.update('\t'.join(mentions.text).encode('utf-8'))
+    return h.digest()
+
+
+class Manifest(object):
+    """Digests of converted documents by PMID in an SQLite DB.
+
+    Each run increments a run number and marks the documents it sees
+    with it; documents from earlier runs that were not seen in the
+    current run are removed. The sources (e.g. name and entity DB
+    versions) are included in the digests, so that any change in them
+    makes all documents change. The output (e.g. directory and layout)
+    is recorded on the first run, and a different output raises
+    ValueError, as the output of unchanged documents would be missing.
+    """
+
+    def __init__(self, fn, sources, output):
+        self.fn = fn
+        self.db = sqlite3.connect(fn)
+        self.db.execute('CREATE TABLE IF NOT EXISTS manifest ('
+                        'pmid TEXT PRIMARY KEY, digest BLOB, run INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                        'key TEXT PRIMARY KEY, value TEXT)')
+        output = repr(output)
+        prev_output = self._get_meta('output')
+        if prev_output is not None and prev_output != output:
+            self.db.close()
+            raise ValueError('{} is for output {}, not {}'.format(
+                fn, prev_output, output))
+        sources = repr((MANIFEST_VERSION, sources))
+        prev_sources = self._get_meta('sources')
+        if prev_sources is not None and prev_sources != sources:
+            info('sources changed since last run of {}'.format(fn))
+        self.run = int(self._get_meta('run', 0)) + 1
+        self._set_meta('sources', sources)
+        self._set_meta('output', output)
+        self._set_meta('run', self.run)
+        self.salt = sources.encode('utf-8')
+        self.counts = {ADDED: 0, CHANGED: 0, REMOVED: 0}
+        self.unchanged = 0
+
+    def _get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, str(value)))
+
+    def filter(self, batch):
+        """Return (document, mentions, digest, status) for changed documents.
+
+        Unchanged documents are marked seen in this run.
+        """
+        digests = [(d.pmid, document_digest(d, m, self.salt))
+                   for d, m in batch]
+        pmids = list(set(pmid for pmid, _ in digests))
+        previous = dict(self.db.execute(
+            'SELECT pmid, digest FROM manifest WHERE pmid IN ({})'.format(
+                ','.join('?' * len(pmids))), pmids))
+        changed, unchanged = [], []
+        for (document, mentions), (pmid, digest) in zip(batch, digests):
+            if pmid not in previous:
+                changed.append((document, mentions, digest, ADDED))
+            elif previous[pmid] != digest:
+                changed.append((document, mentions, digest, CHANGED))
+            else:
+                unchanged.append((self.run, pmid))
+        self.db.executemany('UPDATE manifest SET run = ? WHERE pmid = ?',
+                            unchanged)
+        self.unchanged += len(unchanged)
+        return changed
+
+    def update(self, pmid, digest, status):
+        """Record document as converted in this run."""
+        self.db.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?)',
+                        (pmid, digest, self.run))
+        self.counts[status] += 1
+
+    def removed(self):
+        """Return PMIDs of documents not seen in this run."""
+        return [pmid for pmid, in self.db.execute(
+            'SELECT pmid FROM manifest WHERE run < ?', (self.run,))]
+
+    def remove(self, pmid):
+        self.db.execute('DELETE FROM manifest WHERE pmid = ?', (pmid,))
+        self.counts[REMOVED] += 1
+
+    def commit(self):
+        self.db.commit()
+
+    def summary(self):
+        return '{} added, {} changed, {} removed, {} unchanged'.format(
+            self.counts[ADDED], self.counts[CHANGED], self.counts[REMOVED],
+            self.unchanged)
+
+    def close(self):
+        self.db.close()
@@ -3,48 +3,204 @@
 import sys
 import os
 
+from array import array
+from functools import partial
+from logging import warning
+
 from common import type_name
+from fileio import open_input, is_plain_file, STDIN
+from normdb import LookupTable, SqlTable, is_lookup_table, is_sql_table
+from normdb import write_lookup_table, LUT_SUFFIX
+from checkpoint import file_signature
+from chunkparse import map_chunks
+
+
+# Size of output buffer (lines) in sequential mode
+OUTPUT_BUFFER = 10000
 
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
-    ap.add_argument('dict', help='combined dictionary (run combinedicts.py)')
+    ap.add_argument('-w', '--workers', type=int, metavar='INT', default=None,
+                    help='number of mapping processes (uncompressed input)')
+    ap.add_argument('dict', help='combined dictionary (run combinedicts.py) '
+                    'or lookup or SQL table of it (run makedb.py -a)')
     ap.add_argument('tagged', help='tagger output')                    
     return ap
 
 
 def load_combined(fn):
     serial_map = {}
-    with open(fn) as f:
+    with open_input(fn) as f:
         for ln, l in enumerate(f, start=1):
             l = l.rstrip()
             fields = l.split('\t')
             serial, name, norm = fields
-            serial_map[serial] = (name, norm)
+            # keep first, as the lookup and SQL tables
+            serial_map.setdefault(serial, (name, norm))
     return serial_map
 
 
-def process(fn, serial_map):
-    with open(fn, encoding='utf-8') as f:
+def build_combined_table(fn, tablefn):
+    print('building combined dictionary table {} from {} ... '.format(
+        tablefn, fn), end='', file=sys.stderr, flush=True)
+    source = file_signature(fn)
+    serials, values = array('q'), []
+    with open_input(fn) as f:
         for ln, l in enumerate(f, start=1):
-            l = l.rstrip('\n')
-            fields = l.split('\t')
-            if len(fields) != 8:
-                raise ValueError('line {} in {}: wanted 8 fields, got {}: {}'.\
-                                 format(ln, fn, len(fields), l))
-            pmid, para, sent, start, end, text, type_, serial = fields
-            if serial in serial_map:
-                name, norm = serial_map[serial]
-            tname = type_name(type_)
-            print('\t'.join([
-                pmid, para, sent, start, end, text, tname, name, norm]))
+            l = l.rstrip()
+            serial, name, norm = l.split('\t')
+            serials.append(int(serial))
+            values.append('{}\t{}'.format(name, norm))
+    write_lookup_table(tablefn, serials, values, source)
+    print('done.', file=sys.stderr)
+
+
+def load_combined_table(fn):
+    """Return lookup table for combined dictionary, rebuilt when fn changes.
+
+    The table (see normdb.py) is stored next to fn with LUT_SUFFIX.
+    """
+    tablefn = fn + LUT_SUFFIX
+    table = None
+    if os.path.exists(tablefn):
+        table = LookupTable(tablefn)
+        if table.source != file_signature(fn):
+            table.close()
+            table = None
+    if table is None:
+        build_combined_table(fn, tablefn)
+        table = LookupTable(tablefn)
+    return table
+
+
+class CombinedTable(object):
+    """Combined dictionary lookup or SQL table with (name, norm) values."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __contains__(self, serial):
+        return serial in self.table
+
+    def __getitem__(self, serial):
+        name, norm = self.table[serial].split('\t')
+        return name, norm
+
+    def get(self, serial, default=None):
+        value = self.table.get(serial)
+        if value is None:
+            return default
+        name, norm = value.split('\t')
+        return name, norm
+
+
+def load_dict(fn):
+    if fn != STDIN and is_lookup_table(fn):
+        return CombinedTable(LookupTable(fn))
+    elif fn != STDIN and is_sql_table(fn):
+        return CombinedTable(SqlTable(fn))
+    elif is_plain_file(fn):
+        try:
+            return CombinedTable(load_combined_table(fn))
+        except Exception as e:
+            warning('failed to load table for {}, reading into memory: {}'.\
+                    format(fn, e))
+    return load_combined(fn)
+
+
+def map_lines(lines, serial_map, decode=False):
+    """Map tagged lines, return (output, count, unknown, error).
+
+    Unknown serials are mapped to the mention text and a TAGGER: ID, as
+    in tagged2standoff.py. error is None or (fields, line) for the
+    first line without 8 fields, in which case output and count cover
+    the preceding lines.
+    """
+    output, unknown = [], 0
+    for l in lines:
+        if decode:
+            l = l.decode('utf-8')
+        l = l.rstrip('\n')
+        fields = l.split('\t')
+        if len(fields) != 8:
+            return ''.join(output), len(output), unknown, (len(fields), l)
+        pmid, para, sent, start, end, text, type_, serial = fields
+        mapped = serial_map.get(serial)
+        if mapped is None:
+            unknown += 1
+            name, norm = text, 'TAGGER:{}'.format(serial)
+        else:
+            name, norm = mapped
+        tname = type_name(type_)
+        output.append('\t'.join([
+            pmid, para, sent, start, end, text, tname, name, norm]) + '\n')
+    return ''.join(output), len(output), unknown, None
+
+
+def open_dict(fn):
+    """Return dictionary for fn, opened once per process."""
+    if fn not in open_dict.opened:
+        open_dict.opened[fn] = load_dict(fn)
+    return open_dict.opened[fn]
+open_dict.opened = {}
+
+
+def map_chunk(dictfn, lines):
+    return map_lines(lines, open_dict(dictfn), decode=True)
+
+
+def map_sequential(fn, serial_map):
+    with open_input(fn) as f:
+        lines = []
+        for l in f:
+            lines.append(l)
+            if len(lines) >= OUTPUT_BUFFER:
+                yield map_lines(lines, serial_map)
+                lines = []
+        if lines:
+            yield map_lines(lines, serial_map)
+
+
+def map_parallel(fn, dictfn, serial_map, workers):
+    # Tables are opened by each worker, as a SQLite connection must not
+    # be used across fork(); an in-memory dictionary is inherited.
+    if isinstance(serial_map, dict):
+        open_dict.opened[dictfn] = serial_map
+    yield from map_chunks(fn, partial(map_chunk, dictfn), workers)
+
+
+def process(fn, serial_map, dictfn=None, workers=None, out=sys.stdout):
+    """Write mapped lines of tagged file fn, return number of unknown
+    serials.
+
+    With workers, an uncompressed file is mapped in chunks in parallel,
+    the output remaining in input order.
+    """
+    if workers and dictfn is not None and is_plain_file(fn):
+        results = map_parallel(fn, dictfn, serial_map, workers)
+    else:
+        results = map_sequential(fn, serial_map)
+    ln, total_unknown = 0, 0
+    for output, count, unknown, err in results:
+        out.write(output)
+        ln += count
+        total_unknown += unknown
+        if err is not None:
+            nfields, l = err
+            raise ValueError('line {} in {}: wanted 8 fields, got {}: {}'.\
+                             format(ln+1, fn, nfields, l))
+    if total_unknown:
+        warning('{} mentions with serials not in dictionary'.format(
+            total_unknown))
+    return total_unknown
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    serial_map = load_combined(args.dict)
-    process(args.tagged, serial_map)
+    serial_map = load_dict(args.dict)
+    process(args.tagged, serial_map, args.dict, args.workers)
     return 0
 
 
@@ -0,0 +1,199 @@
+# Columnar store of tagger mentions for analytics.
+#
+# A store is a directory with one .npy file per MentionBatch column
+# (pmid, para, sent, start, end, type and serial, with end offsets
+# exclusive and document IDs, which must be numeric, as integers) and
+# a text column of indices into a deduplicated dictionary of mention
+# texts, stored in the lookup table texts.lut (see normdb.py). The .npy files are written with array.array and
+# have a fixed-size header that is rewritten with the final length
+# when the column is closed. Columns are read with NumPy (memory-
+# mapped) if it is installed, and into arrays otherwise.
+
+import sys
+import os
+import ast
+import struct
+
+from array import array
+from collections import Counter
+
+from normdb import LookupTable, write_lookup_table
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Column names and array typecodes
+COLUMNS = [
+    ('pmid', 'q'),
+    ('para', 'i'),
+    ('sent', 'i'),
+    ('start', 'i'),
+    ('end', 'i'),
+    ('type', 'i'),
+    ('serial', 'q'),
+    ('text', 'i'),
+]
+
+TEXTS = 'texts.lut'
+
+NPY_SUFFIX = '.npy'
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+NPY_DESCR = {'q': '<i8', 'i': '<i4'}
+
+# Total size of .npy header including magic (multiple of 64), leaving
+# room for any shape
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(typecode, count):
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".\
+        format(NPY_DESCR[typecode], count)
+    size = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    header = header.ljust(size - 1) + '\n'
+    return NPY_MAGIC + struct.pack('<H', size) + header.encode('latin1')
+
+
+def read_npy_header(f):
+    """Return (typecode, count) for .npy file f, positioned at data."""
+    if f.read(len(NPY_MAGIC)) != NPY_MAGIC:
+        raise ValueError('not a version 1.0 .npy file: {}'.format(f.name))
+    size, = struct.unpack('<H', f.read(2))
+    header = ast.literal_eval(f.read(size).decode('latin1'))
+    typecodes = {v: k for k, v in NPY_DESCR.items()}
+    if header['descr'] not in typecodes or header['fortran_order']:
+        raise ValueError('unsupported .npy file: {}'.format(f.name))
+    count, = header['shape']
+    return typecodes[header['descr']], count
+
+
+def column_path(directory, name):
+    return os.path.join(directory, name + NPY_SUFFIX)
+
+
+class ColumnWriter(object):
+    """Append arrays to a .npy file."""
+
+    def __init__(self, fn, typecode):
+        self.typecode = typecode
+        self.count = 0
+        self.f = open(fn, 'wb')
+        self.f.write(npy_header(typecode, 0))
+
+    def append(self, values):
+        if sys.byteorder != 'little':
+            values = array(self.typecode, values)
+            values.byteswap()
+        self.f.write(values.tobytes())
+        self.count += len(values)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(npy_header(self.typecode, self.count))
+        self.f.close()
+
+
+class MentionStoreWriter(object):
+    """Write MentionBatches into a mention store directory."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.columns = {
+            name: ColumnWriter(column_path(directory, name), typecode)
+            for name, typecode in COLUMNS
+        }
+        self.text_ids = {}
+
+    def add(self, mentions):
+        try:
+            pmids = array('q', map(int, mentions.pmid))
+        except ValueError:
+            raise ValueError('mention store requires numeric document IDs')
+        self.columns['pmid'].append(pmids)
+        for name, _ in COLUMNS:
+            if name not in ('pmid', 'text'):
+                self.columns[name].append(getattr(mentions, name))
+        text_ids = self.text_ids
+        self.columns['text'].append(array('i', (
+            text_ids.setdefault(t, len(text_ids)) for t in mentions.text)))
+
+    def __len__(self):
+        return self.columns['pmid'].count
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        # dict order is text ID order
+        write_lookup_table(os.path.join(self.directory, TEXTS),
+                           array('q', range(len(self.text_ids))),
+                           list(self.text_ids))
+
+
+class MentionStore(object):
+    """Read access to the columns of a mention store.
+
+    Only the columns asked for are read. With NumPy, columns are
+    memory-mapped numpy arrays; without, they are read into arrays.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(column_path(directory, 'pmid'), 'rb') as f:
+            _, self.count = read_npy_header(f)
+        self._texts = None
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        fn = column_path(self.directory, name)
+        if numpy is not None:
+            values = numpy.load(fn, mmap_mode='r')
+            count = len(values)
+        else:
+            with open(fn, 'rb') as f:
+                typecode, count = read_npy_header(f)
+                values = array(typecode)
+                values.frombytes(f.read())
+            if sys.byteorder != 'little':
+                values.byteswap()
+        if count != self.count:
+            raise ValueError('{} has {} values, expected {}'.format(
+                fn, count, self.count))
+        return values
+
+    def columns(self, *names):
+        return [self.column(name) for name in names]
+
+    @property
+    def texts(self):
+        """Lookup table of mention texts by text column value."""
+        if self._texts is None:
+            self._texts = LookupTable(os.path.join(self.directory, TEXTS))
+        return self._texts
+
+    def text(self, text_id):
+        return self.texts[text_id]
+
+    def close(self):
+        if self._texts is not None:
+            self._texts.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def value_counts(values):
+    """Return Counter of values in column, vectorized with NumPy."""
+    if numpy is not None:
+        unique, counts = numpy.unique(values, return_counts=True)
+        return Counter(dict(zip(unique.tolist(), counts.tolist())))
+    return Counter(values)
@@ -0,0 +1,277 @@
+# Name and entity DBs mapping integer keys to strings: memory-mapped
+# lookup tables and plain SQLite tables.
+#
+# Lookup table file layout (little-endian):
+#
+#     header   HEADER struct: magic, entry count, blob size, source
+#              file size and mtime (0 if unknown)
+#     keys     int64 * count, sorted
+#     offsets  uint64 * (count+1), value i is blob[offsets[i]:offsets[i+1]]
+#     blob     UTF-8 values
+#
+# The file is mapped read-only, so processes opening the same table
+# share one copy in the page cache.
+
+import os
+import mmap
+import struct
+import sqlite3
+
+from array import array
+from bisect import bisect_left
+
+from fileio import open_temporary
+
+
+MAGIC = b'JLLUT001'
+
+HEADER = struct.Struct('<8sQQQq')
+
+LUT_SUFFIX = '.lut'
+
+# Maximum number of keys per bulk query (SQLite variable limit)
+BULK_CHUNK = 500
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+SQL_TABLE = 'normdb'
+
+# Settings for loading SQL tables: no rollback journal or fsync (an
+# interrupted load must be restarted) and a 1GB page cache.
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -1048576',
+]
+
+
+def is_lookup_table(fn):
+    """Return True if fn is a lookup table file."""
+    with open(fn, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def is_sql_table(fn):
+    """Return True if fn is an SQLite DB with a SQL_TABLE table."""
+    with open(fn, 'rb') as f:
+        if f.read(len(SQLITE_MAGIC)) != SQLITE_MAGIC:
+            return False
+    db = sqlite3.connect(fn)
+    try:
+        return db.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND '
+                          'name = ?', ('table', SQL_TABLE)).fetchone() \
+                          is not None
+    finally:
+        db.close()
+
+
+def write_lookup_table(fn, keys, values, source=None):
+    """Write lookup table for keys and values, keeping the first value
+    for repeated keys.
+
+    keys is an array('q') and values a sequence of strings. source is
+    the (size, mtime_ns) signature of the input the table is built from.
+    """
+    order = sorted(range(len(keys)), key=keys.__getitem__)    # stable
+    sorted_keys, offsets, blob = array('q'), array('Q', [0]), bytearray()
+    for i in order:
+        if sorted_keys and sorted_keys[-1] == keys[i]:
+            continue    # only keep first
+        sorted_keys.append(keys[i])
+        blob.extend(values[i].encode('utf-8'))
+        offsets.append(len(blob))
+    size, mtime = source if source is not None else (0, 0)
+    # unique temporary file as several processes may build the same table
+    f, tmpfn = open_temporary(fn)
+    try:
+        with f:
+            f.write(HEADER.pack(MAGIC, len(sorted_keys), len(blob), size,
+                                mtime))
+            f.write(sorted_keys.tobytes())
+            f.write(offsets.tobytes())
+            f.write(blob)
+        os.replace(tmpfn, fn)
+    except BaseException:
+        os.remove(tmpfn)    # e.g. disk full
+        raise
+    return len(sorted_keys)
+
+
+def sqlite_get_many(db, keys):
+    """Return dict of values for int keys found in sqlitedict DB."""
+    query = 'SELECT key, value FROM "{}" WHERE key IN ({})'.format(
+        db.tablename, ','.join('?' * len(keys)))
+    return {int(key): db.decode(value) for key, value
+            in db.conn.select(query, tuple(str(k) for k in keys))}
+
+
+def bulk_get(db, keys):
+    """Return dict of values for int keys found in DB.
+
+    DB is a LookupTable, SqlTable or sqlitedict DB, which is queried for up to
+    BULK_CHUNK keys at a time. Queries are counted in
+    bulk_get.round_trips.
+    """
+    keys, found = list(keys), {}
+    if isinstance(db, LookupTable):
+        bulk_get.round_trips += 1
+        return db.get_many(keys)
+    elif isinstance(db, SqlTable):
+        get_many = db.get_many
+    else:
+        get_many = lambda keys: sqlite_get_many(db, keys)
+    for i in range(0, len(keys), BULK_CHUNK):
+        bulk_get.round_trips += 1
+        found.update(get_many(keys[i:i+BULK_CHUNK]))
+    return found
+bulk_get.round_trips = 0
+
+
+class LookupTable(object):
+    """Read-only dict-like view of a lookup table file."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, blob_size, size, mtime = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError('not a lookup table: {}'.format(fn))
+        self.source = (size, mtime) if size or mtime else None
+        self._view = memoryview(self._mmap)
+        start = HEADER.size
+        self.keys = self._view[start:start+8*count].cast('q')
+        start += 8*count
+        self.offsets = self._view[start:start+8*(count+1)].cast('Q')
+        start += 8*(count+1)
+        self.blob = self._view[start:start+blob_size]
+
+    def _index(self, key):
+        try:
+            key = int(key)
+        except ValueError:
+            return None
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def _value(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        return default if i is None else self._value(i)
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i is None:
+            raise KeyError(key)
+        return self._value(i)
+
+    def __contains__(self, key):
+        return self._index(key) is not None
+
+    def get_many(self, keys):
+        """Return dict of values for keys found in table."""
+        found = {}
+        for key in keys:
+            i = self._index(key)
+            if i is not None:
+                found[key] = self._value(i)
+        return found
+
+    def __len__(self):
+        return len(self.keys)
+
+    def items(self):
+        for i, key in enumerate(self.keys):
+            yield key, self._value(i)
+
+    def close(self):
+        if self._mmap is not None:
+            for view in (self.keys, self.offsets, self.blob, self._view):
+                view.release()
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SqlTable(object):
+    """Read-only dict-like view of a plain SQLite key-value table."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.db = sqlite3.connect(fn)
+
+    def get(self, key, default=None):
+        try:
+            key = int(key)
+        except ValueError:
+            return default
+        row = self.db.execute('SELECT value FROM {} WHERE key = ?'.format(
+            SQL_TABLE), (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get_many(self, keys):
+        """Return dict of values for int keys found in table."""
+        query = 'SELECT key, value FROM {} WHERE key IN ({})'.format(
+            SQL_TABLE, ','.join('?' * len(keys)))
+        return dict(self.db.execute(query, [int(k) for k in keys]))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM {}'.format(
+            SQL_TABLE)).fetchone()[0]
+
+    def items(self):
+        return self.db.execute('SELECT key, value FROM {} ORDER BY key'.\
+                               format(SQL_TABLE))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SqlTableWriter(object):
+    """Bulk loader for SqlTable, keeping the first value for each key."""
+
+    def __init__(self, fn):
+        self.db = sqlite3.connect(fn, isolation_level=None)
+        for pragma in BULK_LOAD_PRAGMAS:
+            self.db.execute(pragma)
+        self.db.execute('CREATE TABLE IF NOT EXISTS {} ('
+                        'key INTEGER PRIMARY KEY, value TEXT)'.format(
+                            SQL_TABLE))
+        self.db.execute('BEGIN')
+
+    def insert(self, rows):
+        """Insert (key, value) rows, return number of new keys."""
+        cursor = self.db.executemany('INSERT OR IGNORE INTO {} VALUES '
+                                     '(?, ?)'.format(SQL_TABLE), rows)
+        return cursor.rowcount
+
+    def close(self):
+        self.db.execute('COMMIT')
+        self.db.close()
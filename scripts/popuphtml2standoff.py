@@ -10,6 +10,8 @@ from collections import defaultdict
 from html.parser import HTMLParser
 from logging import warn, error
 
+from sinks import DirectorySink, WriterPool, DEFAULT_WRITERS
+
 
 EXTRACT_DATA_CONTENT_CLASS = 'content'
 EXTRACT_DATA_DIV_CLASS = 'ajax_table'
@@ -42,6 +44,10 @@ def argparser():
     ap = argparse.ArgumentParser()
     ap.add_argument('-d', '--directory', default=None,
                     help='Output directory')
+    ap.add_argument('--writers', metavar='INT', type=int,
+                    default=DEFAULT_WRITERS,
+                    help='Number of threads writing output, 0 to write in '
+                    'main thread (default {})'.format(DEFAULT_WRITERS))
     ap.add_argument('files', metavar='FILE', nargs='+', help='Input files')
     return ap
 
@@ -225,27 +231,22 @@ def group_by_type(ids, id_map):
 
 def write_standoff(fn, text, spans, identifiers, options):
     id_map = create_id_map(identifiers)
-    txt_fn = os.path.splitext(os.path.basename(fn))[0] + '.txt'
-    ann_fn = os.path.splitext(os.path.basename(fn))[0] + '.ann'
-    if options.directory is not None:
-        txt_fn = os.path.join(options.directory, txt_fn)
-        ann_fn = os.path.join(options.directory, ann_fn)
-    with open(txt_fn, 'w') as out:
-        print(text, file=out)
-    with open(ann_fn, 'w') as out:
-        t_seq, n_seq = 1, 1
-        for start, end, ids in spans:
-            ref = text[start:end]
-            grouped = group_by_type(ids, id_map)
-            for type_, name_id_origtype_list in grouped.items():
-                print('T{}\t{} {} {}\t{}'.format(t_seq, type_, start, end, ref),
-                      file=out)
-                for name, id_, orig_type in name_id_origtype_list:
-                    id_ = rewrite_id(id_, orig_type)
-                    print('N{}\tReference T{} {}\t{}'.\
-                          format(n_seq, t_seq, id_, name), file=out)
-                    n_seq += 1
-                t_seq += 1
+    doc_id = os.path.splitext(os.path.basename(fn))[0]
+    lines = []
+    t_seq, n_seq = 1, 1
+    for start, end, ids in spans:
+        ref = text[start:end]
+        grouped = group_by_type(ids, id_map)
+        for type_, name_id_origtype_list in grouped.items():
+            lines.append('T{}\t{} {} {}\t{}\n'.format(t_seq, type_, start, end,
+                                                     ref))
+            for name, id_, orig_type in name_id_origtype_list:
+                id_ = rewrite_id(id_, orig_type)
+                lines.append('N{}\tReference T{} {}\t{}\n'.\
+                             format(n_seq, t_seq, id_, name))
+                n_seq += 1
+            t_seq += 1
+    options.write(doc_id, text + '\n', ''.join(lines))
 
 
 def process(fn, options):
@@ -259,8 +260,17 @@ def process(fn, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
+    sink = DirectorySink(args.directory or '')
+    if args.writers > 0:
+        writer = WriterPool(sink.write_files, args.writers)
+        args.write = writer.write
+    else:
+        writer = None
+        args.write = sink.write_files
     for fn in args.files:
         process(fn, args)
+    if writer is not None:
+        writer.close()
     return 0
 
 
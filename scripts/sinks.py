@@ -0,0 +1,475 @@
+# Output sinks for converted documents.
+#
+# Directory output writes '{pmid}.txt' and '{pmid}.ann' files, which
+# can be written by a WriterPool of threads while the next documents
+# are converted.
+#
+# Database output is either a sqlitedict DB with pickled '{pmid}.txt'
+# and '{pmid}.ann' values, or a plain SQLite table
+#
+#     standoff(pmid TEXT PRIMARY KEY, txt TEXT, ann TEXT)
+#
+# Both are read with read_standoff_db() in key order.
+#
+# JSON Lines output has one record per document, with the document
+# text and its textbounds and normalizations
+#
+#     {"pmid": ..., "text": ..., "textbounds": [{"id": ..., "type": ...,
+#      "start": ..., "end": ..., "text": ...}, ...], "normalizations":
+#     [{"id": ..., "tb_id": ..., "norm_id": ..., "text": ...}, ...]}
+#
+# Newlines in strings are escaped, so uncompressed output can be split
+# at any newline (e.g. with chunkparse.file_chunks()).
+#
+# Archive output stores the .txt/.ann pairs of documents in zip
+# shards (shard-00000.zip, shard-00001.zip, ...) in an output
+# directory, starting a new shard when the current one reaches a
+# maximum size. The zip central directory of each shard indexes its
+# members, so single documents can be read without scanning shards.
+
+import os
+import re
+import json
+import queue
+import sqlite3
+import zipfile
+import threading
+
+from logging import info, error
+
+from standoff import Textbound, Normalization
+from fileio import open_output
+
+try:
+    import sqlitedict
+except ImportError:
+    error('failed to import sqlitedict; try `pip3 install sqlitedict`')
+    raise
+
+
+SHARD_FORMAT = 'shard-{:05d}.zip'
+
+SHARD_RE = re.compile(r'^shard-\d{5}\.zip$')
+
+# Default maximum shard size (bytes)
+DEFAULT_SHARD_SIZE = 2**30
+
+ARCHIVE_COMPRESSION = zipfile.ZIP_DEFLATED
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+STANDOFF_TABLE = 'standoff'
+
+# Database formats: sqlitedict and plain SQLite table
+SQLITEDICT, SQL = 'sqlitedict', 'sql'
+
+# Number of rows per executemany() in SqlSink
+INSERT_BATCH = 1000
+
+# Approximate size of JSON Lines output written at a time (characters)
+JSONL_BUFFER = 2**22
+
+# Default number of WriterPool threads and queued items per thread
+DEFAULT_WRITERS = 4
+
+WRITER_QUEUE_SIZE = 64
+
+
+def archive_shards(path):
+    """Return sorted shard paths in directory path (or [path] if it is a
+    shard), empty list if none."""
+    if os.path.isfile(path):
+        return [path] if SHARD_RE.match(os.path.basename(path)) else []
+    elif os.path.isdir(path):
+        return [os.path.join(path, fn) for fn in sorted(os.listdir(path))
+                if SHARD_RE.match(fn)]
+    else:
+        return []
+
+
+def is_archive(path):
+    return bool(archive_shards(path))
+
+
+def standoff_text(document, standoffs):
+    """Return .txt and .ann file contents for document."""
+    txt = '{}\n'.format(document)
+    ann = ''.join('{}\n'.format(s) for s in standoffs)
+    return txt, ann
+
+
+class DirectorySink(object):
+    """Write documents into .txt and .ann files in a directory,
+    optionally in subdirectories named by the first prefix_length
+    characters of the document ID.
+    """
+
+    def __init__(self, directory, prefix_length=None):
+        self.directory = directory
+        self.prefix_length = prefix_length
+        self.known_to_exist = set()
+
+    def output_directory(self, doc_id):
+        if self.prefix_length is None:
+            return self.directory
+        else:
+            return os.path.join(self.directory, doc_id[:self.prefix_length])
+
+    def mkdir_p(self, path):
+        if path and path not in self.known_to_exist:
+            os.makedirs(path, exist_ok=True)
+            self.known_to_exist.add(path)
+
+    def write_files(self, doc_id, txt, ann):
+        outdir = self.output_directory(doc_id)
+        self.mkdir_p(outdir)
+        for ext, content in (('.txt', txt), ('.ann', ann)):
+            path = os.path.join(outdir, doc_id + ext)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+
+    def write(self, document, standoffs):
+        self.write_files(document.pmid, *standoff_text(document, standoffs))
+
+    def remove(self, doc_id):
+        outdir = self.output_directory(doc_id)
+        for ext in ('.txt', '.ann'):
+            path = os.path.join(outdir, doc_id + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class WriterPool(object):
+    """Call write(*args) for items in threads, overlapping output I/O
+    with the caller.
+
+    The queue is bounded, so write() blocks when the threads fall
+    behind. The first exception raised in a thread is raised from the
+    next write(), flush() or close() call, and items queued after it
+    are discarded. Items are written in no particular order.
+    """
+
+    def __init__(self, write, threads=DEFAULT_WRITERS,
+                 queue_size=WRITER_QUEUE_SIZE):
+        self._write = write
+        self._queue = queue.Queue(queue_size * threads)
+        self._error = None
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                if args is None:
+                    return
+                if self._error is None:
+                    self._write(*args)
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, *args):
+        self._check()
+        self._queue.put(args)
+
+    def flush(self):
+        """Wait until queued items are written."""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        if self._threads:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        self._check()
+
+
+def is_standoff_table(fn):
+    """Return True if fn is an SQLite DB with a STANDOFF_TABLE table."""
+    if not os.path.isfile(fn):
+        return False
+    with open(fn, 'rb') as f:
+        if f.read(len(SQLITE_MAGIC)) != SQLITE_MAGIC:
+            return False
+    db = sqlite3.connect(fn)
+    try:
+        return db.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND '
+                          'name = ?', ('table', STANDOFF_TABLE)).fetchone() \
+                          is not None
+    finally:
+        db.close()
+
+
+def database_format(fn):
+    """Return format of existing DB fn, SQLITEDICT for new."""
+    return SQL if is_standoff_table(fn) else SQLITEDICT
+
+
+def read_standoff_db(path, suffix=None):
+    """Yield (key, value) for '{pmid}.txt' and '{pmid}.ann' keys in DB in
+    key order, optionally only keys with suffix.
+
+    Reads with a single cursor. For PMIDs that are numbers, the key
+    order is the same for both database formats, so two DBs can be
+    merged on key.
+    """
+    db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        if is_standoff_table(path):
+            for pmid, txt, ann in db.execute(
+                    'SELECT pmid, txt, ann FROM {} ORDER BY pmid'.format(
+                        STANDOFF_TABLE)):
+                for ext, value in (('.ann', ann), ('.txt', txt)):
+                    if suffix is None or ext == suffix:
+                        yield pmid + ext, value
+        else:
+            for key, value in db.execute(
+                    'SELECT key, value FROM unnamed ORDER BY key'):
+                if suffix is None or os.path.splitext(key)[1] == suffix:
+                    yield key, sqlitedict.decode(value)
+    finally:
+        db.close()
+
+
+class SqliteDictSink(object):
+    """Write documents into a sqlitedict DB."""
+
+    def __init__(self, fn):
+        self.db = sqlitedict.SqliteDict(fn)
+
+    def write(self, document, standoffs):
+        self.db['{}.txt'.format(document.pmid)] = str(document)
+        self.db['{}.ann'.format(document.pmid)] = '\n'.join(
+            str(s) for s in standoffs)
+
+    def remove(self, pmid):
+        for key in ('{}.txt'.format(pmid), '{}.ann'.format(pmid)):
+            if key in self.db:
+                del self.db[key]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class SqlSink(object):
+    """Write documents into a plain SQLite table.
+
+    Rows are inserted INSERT_BATCH at a time in a transaction that
+    lasts until commit(). The DB is in WAL mode, so readers are not
+    blocked by the writer.
+    """
+
+    def __init__(self, fn):
+        self.db = sqlite3.connect(fn, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS {} ('
+                        'pmid TEXT PRIMARY KEY, txt TEXT, ann TEXT)'.format(
+                            STANDOFF_TABLE))
+        self.rows = []
+        self.in_transaction = False
+
+    def _flush(self):
+        if not self.in_transaction:
+            self.db.execute('BEGIN')
+            self.in_transaction = True
+        self.db.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?, ?)'.\
+                            format(STANDOFF_TABLE), self.rows)
+        self.rows = []
+
+    def write(self, document, standoffs):
+        self.rows.append((document.pmid, str(document),
+                          '\n'.join(str(s) for s in standoffs)))
+        if len(self.rows) >= INSERT_BATCH:
+            self._flush()
+
+    def remove(self, pmid):
+        self._flush()
+        self.db.execute('DELETE FROM {} WHERE pmid = ?'.format(
+            STANDOFF_TABLE), (pmid,))
+
+    def commit(self):
+        self._flush()
+        self.db.execute('COMMIT')
+        self.in_transaction = False
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def open_database_sink(fn, format_=None):
+    """Return sink for DB fn, format detected for existing DBs if None.
+
+    Raises ValueError if format_ differs from that of an existing DB.
+    """
+    if os.path.exists(fn) and os.path.getsize(fn) > 0:
+        existing = database_format(fn)
+        if format_ is not None and format_ != existing:
+            raise ValueError('{} is a {} DB, not {}'.format(fn, existing,
+                                                            format_))
+        format_ = existing
+    if format_ == SQL:
+        return SqlSink(fn)
+    else:
+        return SqliteDictSink(fn)
+
+
+class JsonlSink(object):
+    """Write documents as JSON Lines records into a file or STDOUT,
+    compressed by file name suffix (see fileio.open_output()).
+    """
+
+    encode = json.JSONEncoder(ensure_ascii=False, check_circular=False,
+                              separators=(',', ':')).encode
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.f = open_output(fn)
+        self.buffer, self.buffered = [], 0
+        self.count = 0
+
+    def record(self, document, standoffs):
+        textbounds, normalizations = [], []
+        for s in standoffs:
+            if isinstance(s, Textbound):
+                textbounds.append({'id': s.id, 'type': s.type,
+                                   'start': s.start, 'end': s.end,
+                                   'text': s.text})
+            elif isinstance(s, Normalization):
+                normalizations.append({'id': s.id, 'tb_id': s.tb_id,
+                                       'norm_id': s.norm_id, 'text': s.text})
+            else:
+                raise ValueError('unsupported standoff: {}'.format(s))
+        return {'pmid': document.pmid, 'text': document.text,
+                'textbounds': textbounds, 'normalizations': normalizations}
+
+    def write(self, document, standoffs):
+        line = self.encode(self.record(document, standoffs))
+        self.buffer.append(line)
+        self.buffered += len(line) + 1
+        self.count += 1
+        if self.buffered >= JSONL_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append('')    # final newline
+            self.f.write('\n'.join(self.buffer).encode('utf-8'))
+            self.buffer, self.buffered = [], 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class ArchiveSink(object):
+    """Write documents into size-capped zip shards in a directory.
+
+    Shards are written to a temporary name and renamed when complete,
+    so only complete shards are visible to readers. Without documents,
+    a single empty shard is written so that the output is recognized
+    as an archive.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_SHARD_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        if archive_shards(directory):
+            raise ValueError('{} already contains shards'.format(directory))
+        self.directory = directory
+        self.max_size = max_size
+        self.index = 0
+        self.count = 0
+        self._file = None
+        self._zip = None
+
+    def _open(self):
+        self.path = os.path.join(self.directory, SHARD_FORMAT.format(
+            self.index))
+        self._file = open(self.path + '.tmp', 'wb')
+        self._zip = zipfile.ZipFile(self._file, 'w', ARCHIVE_COMPRESSION)
+
+    def _close_shard(self):
+        self._zip.close()
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+        info('wrote {}'.format(self.path))
+        self._zip, self._file = None, None
+        self.index += 1
+
+    def write(self, document, standoffs):
+        if self._zip is None:
+            self._open()
+        txt, ann = standoff_text(document, standoffs)
+        self._zip.writestr('{}.txt'.format(document.pmid), txt)
+        self._zip.writestr('{}.ann'.format(document.pmid), ann)
+        self.count += 1
+        if self._file.tell() >= self.max_size:
+            self._close_shard()
+
+    def close(self):
+        if self._zip is None and self.index == 0:
+            self._open()    # empty archive
+        if self._zip is not None:
+            self._close_shard()
+
+
+class ArchiveReader(object):
+    """Read-only access to members of archive shards by name."""
+
+    def __init__(self, path):
+        self.path = path
+        self.shards = archive_shards(path)
+        self._zips = [zipfile.ZipFile(fn) for fn in self.shards]
+        self._index = None
+
+    def items(self, suffix=None):
+        """Yield (name, content) for members in shard order."""
+        for zf in self._zips:
+            for name in zf.namelist():
+                if suffix is None or os.path.splitext(name)[1] == suffix:
+                    yield name, zf.read(name).decode('utf-8')
+
+    def _shard_index(self):
+        # member name -> ZipFile, from the shard central directories
+        if self._index is None:
+            self._index = {}
+            for zf in self._zips:
+                for name in zf.namelist():
+                    self._index.setdefault(name, zf)
+        return self._index
+
+    def get(self, name, default=None):
+        zf = self._shard_index().get(name)
+        if zf is None:
+            return default
+        return zf.read(name).decode('utf-8')
+
+    def __contains__(self, name):
+        return name in self._shard_index()
+
+    def close(self):
+        for zf in self._zips:
+            zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,16 +3,12 @@
 import sys
 import os
 
-from collections import defaultdict, OrderedDict, Counter
+from collections import defaultdict, Counter
 from logging import info, warning
 
 from standoff import Textbound, Normalization
-
-try:
-    import sqlitedict
-except ImportError:
-    error('failed to import sqlitedict, try `pip3 install sqlitedict`')
-    raise
+from intervalindex import IntervalIndex
+from sinks import ArchiveReader, is_archive, read_standoff_db
 
 
 # Keys for stats dict
@@ -56,34 +52,21 @@ def is_sqlite_db(path):
 
 
 def find_overlapping(textbounds):
-    # Avoiding O(n^2) comparisons: create list of (offset, start/end, tb),
-    # sort with end<start, and then iterate over the list while maintaining
-    # a list of currently open.
-    START, END = 's', 'e', #1, -1    # need END < START for sort to work right
-    boundaries = []
+    """Return (t1, t2) pairs of overlapping textbounds.
+
+    Pairs are ordered as textbounds are (by start, longest first), with
+    t1 before t2, and grouped by t2.
+    """
+    valid = []
     for t in textbounds:
         if t.end <= t.start:
-            # TODO: zero-widths require special treatment: as ends sort
-            # before starts, the basic algorithm doesn't work if end==start.
             warning('find_overlapping: ignoring zero-width textbound: {}'.\
                     format(t))
             continue
-        boundaries.append((t.start, START, t))
-        boundaries.append((t.end, END, t))
-    boundaries.sort()
-
-    overlapping = []
-    open_textbounds = OrderedDict()
-    for offset, boundary, textbound in boundaries:
-        if boundary == START:    # overlaps with everything currently open
-            for t in open_textbounds.values():
-                overlapping.append((t, textbound))
-            assert textbound.id not in open_textbounds, 'duplicate id'
-            open_textbounds[textbound.id] = textbound
-        else:
-            assert boundary == END
-            del open_textbounds[textbound.id]
-    return overlapping
+        valid.append(t)
+    valid.sort()
+    index = IntervalIndex(valid)
+    return [(valid[i], valid[j]) for i, j in index.overlapping_pairs()]
 
 
 def generate_id(prefix):
@@ -148,15 +131,8 @@ def take_stats(txt, ann, fn, stats):
         stats[CONSISTENCY]['inconsistent'] += 1
             
 def process_db(path, stats, options):
-    # No context manager: close() can block and this is read-only
-    db = sqlitedict.SqliteDict(path, flag='r', autocommit=False)
     count = 0
-    for key, val in db.items():
-        root, ext = os.path.splitext(key)
-        if ext != options.suffix:
-            continue
-        # txt_key = '{}.txt'.format(root)
-        # txt = db[txt_key]     # everything hangs if I do this
+    for key, val in read_standoff_db(path, options.suffix):
         take_stats('', val, key, stats)
         count += 1
         if options.limit is not None and count >= options.limit:
@@ -166,9 +142,24 @@ def process_db(path, stats, options):
     return count
 
 
+def process_archive(path, stats, options):
+    count = 0
+    with ArchiveReader(path) as archive:
+        for name, val in archive.items(options.suffix):
+            take_stats('', val, name, stats)
+            count += 1
+            if options.limit is not None and count >= options.limit:
+                break
+
+    print('Done, processed {}.'.format(count), file=sys.stderr)
+    return count
+
+
 def process(path, options):
     stats = defaultdict(Counter)
-    if is_sqlite_db(path):
+    if is_archive(path):
+        count = process_archive(path, stats, options)
+    elif is_sqlite_db(path):
         count = process_db(path, stats, options)
     else:
         raise NotImplementedError('filesystem input ({})'.format(path))
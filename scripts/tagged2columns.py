@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Convert tagger output into a columnar mention store (see
+# mentionstore.py).
+
+import sys
+
+from functools import partial
+from logging import warning
+
+from common import MentionBatch, Mention, skippable_line
+from fileio import open_input, is_plain_file
+from chunkparse import map_chunks
+from mentionstore import MentionStoreWriter
+
+
+# Number of lines parsed at a time in sequential mode
+BATCH_LINES = 100000
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('-w', '--workers', type=int, metavar='INT', default=None,
+                    help='number of parsing processes (uncompressed input)')
+    ap.add_argument('tags', help='tsv file with tags for documents '
+                    '(may be compressed, "-" for STDIN)')
+    ap.add_argument('store', help='output mention store directory')
+    return ap
+
+
+def parse_lines(lines, decode=False):
+    """Return (MentionBatch, count, skipped, error) for tagger lines.
+
+    count is the number of lines parsed. error is None or
+    (fields, line) for the first line without 8 fields, in which case
+    the batch covers the preceding lines.
+    """
+    rows, skipped = [], 0
+    for i, line in enumerate(lines):
+        if decode:
+            line = line.decode('utf-8')
+        line = line.rstrip('\n')
+        if skippable_line(line):
+            skipped += 1
+            continue
+        fields = line.split('\t')
+        if len(fields) != 8:
+            return MentionBatch.from_fields(rows), i, skipped, fields
+        rows.append(fields)
+    return MentionBatch.from_fields(rows), len(lines), skipped, None
+
+
+def parse_sequential(fn):
+    with open_input(fn) as f:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) >= BATCH_LINES:
+                yield parse_lines(lines)
+                lines = []
+        if lines:
+            yield parse_lines(lines)
+
+
+def convert(fn, store, workers=None):
+    """Write mentions in tagger output file fn to MentionStoreWriter."""
+    if workers and is_plain_file(fn):
+        results = map_chunks(fn, partial(parse_lines, decode=True), workers)
+    else:
+        results = parse_sequential(fn)
+    ln, total_skipped = 0, 0
+    for mentions, count, skipped, err in results:
+        store.add(mentions)
+        ln += count
+        total_skipped += skipped
+        if err is not None:
+            Mention.from_fields(err, ln+1, fn)    # raises
+        print('Read {} lines ...'.format(ln), end='\r', file=sys.stderr,
+              flush=True)
+    if total_skipped:
+        warning('skipped {} empty or comment lines in {}'.format(
+            total_skipped, fn))
+    return ln
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    store = MentionStoreWriter(args.store)
+    convert(args.tags, store, args.workers)
+    store.close()    # not on error, leaving the store empty
+    print('Done, wrote {} mentions with {} distinct texts to {}.'.format(
+        len(store), len(store.text_ids), args.store), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,15 +2,27 @@
 
 import sys
 import os
-import errno
+import copy
 
 from itertools import count
+from multiprocessing import Pool
 from collections import defaultdict
 from logging import info, warning, error
 
 from standoff import Textbound, Normalization
-from common import read_streams
-from common import get_norm_name, get_norm_id, rewrite_norm_id
+from fileio import open_input, is_plain_file
+from tagjoin import read_batches_unordered, DEFAULT_MEMORY
+from checkpoint import save_checkpoint, load_checkpoint, file_signature
+from manifest import Manifest, REMOVED
+from normdb import LookupTable, SqlTable, is_lookup_table, is_sql_table
+from sinks import ArchiveSink, DEFAULT_SHARD_SIZE, SQLITEDICT, SQL
+from sinks import open_database_sink, DirectorySink, WriterPool
+from sinks import DEFAULT_WRITERS, JsonlSink, database_format
+from common import read_batches, shard_streams, LineReader, Position
+from common import type_info, resolve_mention
+from common import prefetch_norms, set_norm_cache_size, DEFAULT_CACHE_SIZE
+from common import norm_stats, reset_norm_stats, add_norm_stats
+from common import report_norm_stats, load_norm_caches, save_norm_caches
 
 try:
     import sqlitedict
@@ -25,40 +37,88 @@ def argparser():
     ap.add_argument('-l', '--limit', type=int, metavar='INT', default=None,
                     help='maximum number of documents to convert')
     ap.add_argument('-e', '--entitydb', default=None,
-                    help='sqlite DB mapping tagger IDs to external IDs')
+                    help='DB mapping tagger IDs to external IDs '
+                    '(sqlite or lookup table)')
     ap.add_argument('-n', '--namedb', default=None,
-                    help='sqlite DB mapping tagger IDs to names')
+                    help='DB mapping tagger IDs to names '
+                    '(sqlite or lookup table)')
+    ap.add_argument('-R', '--resolution', metavar='TABLE', default=None,
+                    help='resolution table (run combinedicts.py -R)')
     ap.add_argument('-d', '--directory', default=None,
                     help='output directory (default STDOUT)')
     ap.add_argument('-D', '--database', default=None,
                     help='output database (default STDOUT)')
+    ap.add_argument('-F', '--db-format', choices=(SQLITEDICT, SQL),
+                    default=None,
+                    help='--database format (default that of existing DB, '
+                    'otherwise {})'.format(SQLITEDICT))
+    ap.add_argument('-T', '--transaction-size', metavar='INT', type=int,
+                    default=COMMIT_INTERVAL,
+                    help='number of documents per --database transaction '
+                    '(default {})'.format(COMMIT_INTERVAL))
+    ap.add_argument('-J', '--jsonl', metavar='FILE', default=None,
+                    help='output JSON Lines records to FILE ("-" for '
+                    'STDOUT, compressed if ending in .gz, .bz2, .xz or .zst)')
+    ap.add_argument('-A', '--archive', metavar='DIR', default=None,
+                    help='output zip archive shards in DIR')
+    ap.add_argument('--shard-size', metavar='MB', type=int,
+                    default=DEFAULT_SHARD_SIZE//2**20,
+                    help='maximum --archive shard size (default {})'.format(
+                        DEFAULT_SHARD_SIZE//2**20))
     ap.add_argument('-P', '--dir-prefix', type=int, default=None,
                     help='add subdirectories with given length doc ID prefix')
-    ap.add_argument('docs', help='tsv file with document text and data')
-    ap.add_argument('tags', help='tsv file with tags for documents')
+    ap.add_argument('--writers', metavar='INT', type=int,
+                    default=DEFAULT_WRITERS,
+                    help='number of threads writing --directory output, 0 '
+                    'to write in main thread (default {})'.format(
+                        DEFAULT_WRITERS))
+    ap.add_argument('-w', '--workers', type=int, metavar='INT', default=None,
+                    help='number of worker processes (default 1)')
+    ap.add_argument('-r', '--resume', default=False, action='store_true',
+                    help='resume --database output from last checkpoint')
+    ap.add_argument('-I', '--incremental', metavar='MANIFEST', default=None,
+                    help='only convert documents changed since last run '
+                    'recorded in MANIFEST')
+    ap.add_argument('-C', '--changes', metavar='FILE', default=None,
+                    help='write added/changed/removed PMIDs to FILE '
+                    '(with --incremental)')
+    ap.add_argument('-c', '--cache-size', metavar='INT', type=int,
+                    default=DEFAULT_CACHE_SIZE,
+                    help='maximum number of cached DB values (default {})'.\
+                    format(DEFAULT_CACHE_SIZE))
+    ap.add_argument('--cache-file', metavar='FILE', default=None,
+                    help='load DB value cache from FILE and save it there '
+                    'after the run (not saved with --workers)')
+    ap.add_argument('-u', '--unordered', default=False, action='store_true',
+                    help='tags are not in the same order as documents')
+    ap.add_argument('-M', '--memory', metavar='MB', type=int,
+                    default=DEFAULT_MEMORY//2**20,
+                    help='memory budget for --unordered tags (default {})'.\
+                    format(DEFAULT_MEMORY//2**20))
+    ap.add_argument('docs', help='tsv file with document text and data '
+                    '(may be compressed, "-" for STDIN)')
+    ap.add_argument('tags', help='tsv file with tags for documents '
+                    '(may be compressed, "-" for STDIN)')
     return ap
 
 
 def mentions_to_standoffs(mentions, options):
+    """Return standoffs for MentionBatch."""
     standoffs = []
     # Mentions with identical span and type map to one textbound with
     # multiple normalizations.
     grouped = defaultdict(list)
-    for m in mentions:
-        grouped[(m.start, m.end, m.typename, m.text)].append(m)
+    for i, (start, end, type_, text) in enumerate(zip(
+            mentions.start, mentions.end, mentions.type, mentions.text)):
+        grouped[(start, end, type_info(type_)[0], text)].append(i)
     t_idx, n_idx = count(1), count(1)
     for (start, end, type_, text), group in sorted(grouped.items()):
         t_id = 'T{}'.format(next(t_idx))
         standoffs.append(Textbound(t_id, type_, start, end, text))
-        for m in group:
+        for i in group:
             n_id = 'N{}'.format(next(n_idx))
-            n_name = get_norm_name(m.serial, m.text, options)
-            # if we have a species name, add it to the norm text
-            if m.species:
-                n_name = n_name + ' ({})'.format(m.species)
-            norm_id = get_norm_id(m.serial, 'TAGGER:{}'.format(m.serial),
-                                  options)
-            norm_id = rewrite_norm_id(norm_id, type_, m.species)
+            _, norm_id, n_name = resolve_mention(
+                mentions.serial[i], mentions.type[i], text, options)
             standoffs.append(Normalization(n_id, t_id, norm_id, n_name))
     return standoffs
 
@@ -68,95 +128,410 @@ def skippable_line(line):
     return len(line) == 0 or line.isspace() or line[0] == '#'
 
 
-def output_directory(doc_id, options):
-    """Return directory to store document with given ID in."""
-    assert options.directory, 'internal error'
-    if options.dir_prefix is None:
-        return options.directory
-    else:
-        return os.path.join(options.directory, doc_id[:options.dir_prefix])
+# Number of shards to create per worker process (load balancing) and
+# maximum size of the docs file range in a shard (memory use).
+SHARDS_PER_WORKER = 4
 
+MAX_SHARD_SIZE = 2**26
 
-# https://stackoverflow.com/a/600612
-def mkdir_p(path):
-    if path in mkdir_p.known_to_exist:
-        return
-    try:
-        os.makedirs(path)
-        mkdir_p.known_to_exist.add(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            mkdir_p.known_to_exist.add(path)
-        else:
-            raise
-mkdir_p.known_to_exist = set()
+# Number of documents between database commits
+COMMIT_INTERVAL = 10000
 
 
 def write_standoff(document, mentions, options):
     standoffs = mentions_to_standoffs(mentions, options)
-    if options.directory is None and options.database is None:    # STDOUT
+    output_standoff(document, standoffs, options)
+
+
+def output_standoff(document, standoffs, options):
+    if (options.directory is None and options.database is None and
+        options.archive is None and options.jsonl is None):    # STDOUT
         print(document)
         for s in standoffs:
             print(s)
+    elif options.jsonl is not None:
+        options.jsonl.write(document, standoffs)
+    elif options.archive is not None:
+        options.archive.write(document, standoffs)
     elif options.database is not None:
-        txt_key = '{}.txt'.format(document.pmid)
-        ann_key = '{}.ann'.format(document.pmid)
-        options.database[txt_key] = str(document)
-        options.database[ann_key] = '\n'.join(str(s) for s in standoffs)
+        options.database.write(document, standoffs)
+    elif options.writer is not None:
+        options.writer.write(document, standoffs)
     else:
-        outdir = output_directory(document.pmid, options)
-        mkdir_p(outdir)
-        txt_fn = os.path.join(outdir, '{}.txt'.format(document.pmid))
-        ann_fn = os.path.join(outdir, '{}.ann'.format(document.pmid))
-        with open(txt_fn, 'w', encoding='utf-8') as txt_f:
-            print(document, file=txt_f)
-        with open(ann_fn, 'w', encoding='utf-8') as ann_f:
-            for s in standoffs:
-                print(s, file=ann_f)
-              
+        options.dir_sink.write(document, standoffs)
 
-def process(docfn, tagfn, options):
-    count = 0
-    with open(docfn, encoding='utf-8') as docf:
-        with open(tagfn, encoding='utf-8') as tagf:
-            for document, mentions in read_streams(docf, tagf):
-                if options.limit and count >= options.limit:
-                    break
-                write_standoff(document, mentions, options)
-                count += 1
-                if count % 1024 == 0:
-                    print('Processed {} ...'.format(count), end='\r',
-                          file=sys.stderr, flush=True)
-                if options.database and count % 10000 == 0:
-                    print('Processed {}, committing ...'.format(count),
-                          file=sys.stderr)
-                    options.database.commit()
+
+def remove_standoff(pmid, options):
+    if options.database is not None:
+        options.database.remove(pmid)
+    elif options.directory is not None:
+        if options.writer is not None:
+            options.writer.flush()
+        options.dir_sink.remove(pmid)
+
+
+def report_change(pmid, status, options):
+    if options.changes is not None:
+        print('{}\t{}'.format(status, pmid), file=options.changes)
+
+
+def write_changed(batch, options):
+    """Write documents in batch that changed since last run."""
+    manifest = options.manifest
+    changed = manifest.filter(batch)
+    prefetch_norms([(d, m) for d, m, _, _ in changed], options)
+    for document, mentions, digest, status in changed:
+        write_standoff(document, mentions, options)
+        manifest.update(document.pmid, digest, status)
+        report_change(document.pmid, status, options)
+
+
+def remove_unseen(options):
+    """Remove output for documents not in input since last run."""
+    manifest = options.manifest
+    for pmid in manifest.removed():
+        remove_standoff(pmid, options)
+        manifest.remove(pmid)
+        report_change(pmid, REMOVED, options)
+
+
+def report_progress(count, options):
+    if count % 1024 == 0:
+        print('Processed {} ...'.format(count), end='\r',
+              file=sys.stderr, flush=True)
+
+
+def commit(count, position, options):
+    """Commit database and store checkpoint if checkpointing.
+
+    The checkpoint position is where reading continues after count
+    documents, or None when the input is fully processed.
+    """
+    if options.writer is not None:
+        options.writer.flush()
+    if options.database is not None:
+        options.database.commit()
+    if options.manifest is not None:
+        options.manifest.commit()
+    if options.checkpointing:
+        save_checkpoint(options.dbname, {
+            'docs': file_signature(options.docs),
+            'tags': file_signature(options.tags),
+            'count': count,
+            'position': position,
+        })
+
+
+def maybe_commit(count, prev_count, position, options):
+    """Commit if count passed a multiple of the transaction size."""
+    interval = options.transaction_size
+    if ((options.database is not None or options.manifest is not None) and
+        count // interval != prev_count // interval):
+        print('Processed {}, committing ...'.format(count), file=sys.stderr)
+        commit(count, position, options)
+
+
+def finish(count, position, complete, options):
+    """Close outputs and commit. complete is True if all input was
+    processed (not stopped by --limit), and only then is output for
+    documents not seen removed with --incremental."""
+    if options.writer is not None:
+        options.writer.close()
     print('Done, processed {} documents.'.format(count), file=sys.stderr)
-    if options.database:
+    if options.jsonl is not None:
+        options.jsonl.close()
+    if options.archive is not None:
+        options.archive.close()
+        print('Wrote {} shards to {}.'.format(options.archive.index,
+                                              options.archive.directory),
+              file=sys.stderr)
+    report_norm_stats(options)
+    if options.manifest is not None:
+        if complete:
+            remove_unseen(options)
+        print('{}: {}.'.format(options.incremental,
+                               options.manifest.summary()), file=sys.stderr)
+    if options.database is not None or options.manifest is not None:
         print('Committing ...', end='', flush=True, file=sys.stderr)
-        options.database.commit()
+        commit(count, position, options)
         print('done.', file=sys.stderr)
+    if options.database is not None:
+        options.database.close()
     return count
 
 
+def resume_point(options):
+    """Return (count, Position) to resume from, see commit()."""
+    state = load_checkpoint(options.dbname)
+    if state is None:
+        warning('no checkpoint for {}, starting from beginning'.format(
+            options.dbname))
+        return 0, Position(0, 1, 0, 1)
+    if (state['docs'] != file_signature(options.docs) or
+        state['tags'] != file_signature(options.tags)):
+        raise ValueError('inputs changed since checkpoint for {}'.format(
+            options.dbname))
+    print('Resuming after {} documents.'.format(state['count']),
+          file=sys.stderr)
+    return state['count'], state['position']
+
+
+def init_worker(options, entitydb, namedb, resolution):
+    if options.directory is not None:
+        options.writer = open_writer(options)
+    if resolution is not None:
+        options.resolution = LookupTable(resolution)
+    if entitydb is not None:
+        options.entitydb = open_db(entitydb)
+    if namedb is not None:
+        options.namedb = open_db(namedb)
+    convert_shard.options = options
+
+
+def convert_shard(shard):
+    """Convert shard in worker process.
+
+    Output to directory is written by the worker and only the document
+    count returned; otherwise, (document, standoffs) pairs are returned
+    for output by the main process. DB lookup statistics (see
+    common.norm_stats()) for the shard are also returned.
+    """
+    options = convert_shard.options
+    start, end = shard.start, shard.end
+    count, converted = 0, []
+    reset_norm_stats()
+    with LineReader(options.docs, start.doc_offset, end.doc_offset) as docf:
+        with LineReader(options.tags, start.tag_offset,
+                        end.tag_offset) as tagf:
+            for batch in read_batches(docf, tagf, limit=shard.count,
+                                      doc_start=start.doc_ln,
+                                      tag_start=start.tag_ln):
+                prefetch_norms(batch, options)
+                for document, mentions in batch:
+                    standoffs = mentions_to_standoffs(mentions, options)
+                    if options.directory is not None:
+                        output_standoff(document, standoffs, options)
+                    else:
+                        converted.append((document, standoffs))
+                    count += 1
+    if options.writer is not None:
+        options.writer.flush()    # output complete when shard is counted
+    return count, converted, norm_stats()
+convert_shard.options = None
+
+
+def process_parallel(docfn, tagfn, entitydb, namedb, resolution, options):
+    print('Splitting {} and {} ...'.format(docfn, tagfn), end='',
+          file=sys.stderr, flush=True)
+    workers = options.workers
+    max_size = os.path.getsize(docfn) // (workers * SHARDS_PER_WORKER) + 1
+    max_size = min(max_size, MAX_SHARD_SIZE)
+    count, position = 0, None
+    if options.resume:
+        count, position = resume_point(options)
+        if position is None:
+            return finish(count, position, True, options)    # already done
+    limit = options.limit - count if options.limit else None
+    shards = shard_streams(docfn, tagfn, max_size, limit, position)
+    print('done, {} shards.'.format(len(shards)), file=sys.stderr)
+    # Workers get their own copy of the options with DBs opened in
+    # init_worker() (open DB handles cannot be passed to processes).
+    worker_options = copy.copy(options)
+    worker_options.database = None
+    worker_options.archive = None
+    worker_options.jsonl = None
+    worker_options.entitydb = None
+    worker_options.namedb = None
+    worker_options.resolution = None
+    with Pool(workers, init_worker,
+              (worker_options, entitydb, namedb, resolution)) as pool:
+        results = pool.imap(convert_shard, shards)
+        for shard, (shard_count, converted, stats) in zip(shards, results):
+            add_norm_stats(stats)
+            prev_count = count
+            if options.directory is not None:
+                count += shard_count
+                print('Processed {} ...'.format(count), end='\r',
+                      file=sys.stderr, flush=True)
+            for document, standoffs in converted:
+                output_standoff(document, standoffs, options)
+                count += 1
+                report_progress(count, options)
+            position = shard.end if shard.end.tag_offset is not None else None
+            maybe_commit(count, prev_count, position, options)
+    complete = limit is None or count < options.limit
+    return finish(count, position, complete, options)
+
+
+def reader(docf, tagf, limit, start, options):
+    if options.unordered:
+        return read_batches_unordered(docf, tagf, limit=limit,
+                                      memory=options.memory*2**20)
+    else:
+        return read_batches(docf, tagf, limit=limit, doc_start=start.doc_ln,
+                            tag_start=start.tag_ln)
+
+
+def open_streams(docfn, tagfn, start, options):
+    """Open docs and tags, as LineReaders from start when checkpointing."""
+    if options.checkpointing:
+        return (LineReader(docfn, start.doc_offset),
+                LineReader(tagfn, start.tag_offset))
+    else:
+        return open_input(docfn), open_input(tagfn)
+
+
+def process(docfn, tagfn, options):
+    count, position = 0, Position(0, 1, 0, 1)
+    if options.resume:
+        count, position = resume_point(options)
+        if position is None:
+            return finish(count, position, True, options)    # already done
+    limit = options.limit - count if options.limit else None
+    docf, tagf = open_streams(docfn, tagfn, position, options)
+    with docf, tagf:
+        for batch in reader(docf, tagf, limit, position, options):
+            prev_count = count
+            if options.manifest is not None:
+                write_changed(batch, options)
+                count += len(batch)
+                report_progress(count, options)
+            else:
+                prefetch_norms(batch, options)
+                for document, mentions in batch:
+                    write_standoff(document, mentions, options)
+                    count += 1
+                    report_progress(count, options)
+            position = batch.position
+            maybe_commit(count, prev_count, position, options)
+    # Batch positions are only known when checkpointing
+    complete = limit is None or count < options.limit
+    if complete:
+        position = None    # all input processed
+    return finish(count, position, complete, options)
+
+
+def open_writer(options):
+    """Return WriterPool for --directory output, None if not threaded."""
+    if options.writers > 0:
+        return WriterPool(options.dir_sink.write, options.writers)
+    return None
+
+
 def open_db(fn, flag='r'):
     if not os.path.exists(fn):
         raise IOError("no such file: '{}'".format(fn))
+    if is_lookup_table(fn):
+        return LookupTable(fn)
+    if is_sql_table(fn):
+        return SqlTable(fn)
     return sqlitedict.SqliteDict(fn, flag=flag)
 
 
+def output_settings(options):
+    """Return the options determining where and how documents are
+    written, before output is opened."""
+    directory, database, db_format = None, None, None
+    if options.directory:
+        directory = os.path.abspath(options.directory)
+    if options.database:
+        database = os.path.abspath(options.database)
+        db_format = options.db_format or database_format(database)
+    return directory, options.dir_prefix, database, db_format
+
+
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    if args.directory and args.database:
-        error('cannot output to both --directory and --database')
+    if sum(o is not None for o in
+           (args.directory, args.database, args.archive, args.jsonl)) > 1:
+        error('only one of --directory, --database, --archive and --jsonl '
+              'allowed')
         return 1
-    if args.database:
-        args.database = sqlitedict.SqliteDict(args.database)
+    if args.workers is not None and args.workers < 1:
+        error('--workers must be 1 or greater')
+        return 1
+    if args.workers is not None and args.workers > 1 and args.unordered:
+        error('cannot combine --workers and --unordered')
+        return 1
+    if (args.workers is not None and args.workers > 1 and
+        not (is_plain_file(args.docs) and is_plain_file(args.tags))):
+        error('--workers requires uncompressed docs and tags files')
+        return 1
+    # Checkpoints need byte offsets in the inputs (see commit())
+    args.dbname = args.database
+    args.checkpointing = (args.database is not None and not args.unordered and
+                          is_plain_file(args.docs) and
+                          is_plain_file(args.tags))
+    if args.incremental and (args.resume or
+                             (args.workers is not None and args.workers > 1)):
+        error('cannot combine --incremental with --resume or --workers')
+        return 1
+    if args.incremental and (args.archive or args.jsonl):
+        error('cannot combine --incremental with --archive or --jsonl')
+        return 1
+    if args.changes and not args.incremental:
+        error('--changes requires --incremental')
+        return 1
+    if args.resume and not args.checkpointing:
+        error('--resume requires --database output from uncompressed, '
+              'ordered docs and tags files')
+        return 1
+    if args.writers < 0:
+        error('--writers must be 0 or greater')
+        return 1
+    if args.transaction_size < 1:
+        error('--transaction-size must be 1 or greater')
+        return 1
+    entitydb, namedb, resolution = args.entitydb, args.namedb, args.resolution
+    if args.resolution is not None:
+        args.resolution = LookupTable(args.resolution)
     if args.entitydb is not None:
         args.entitydb = open_db(args.entitydb)
     if args.namedb is not None:
         args.namedb = open_db(args.namedb)
-    count = process(args.docs, args.tags, args)
+    sources = [file_signature(fn) if fn is not None else None
+               for fn in (entitydb, namedb, resolution)]
+    output = output_settings(args)
+    args.manifest = None
+    if args.incremental:
+        # Any change in the name or entity DB can change all output
+        try:
+            args.manifest = Manifest(args.incremental, sources, output)
+        except ValueError as e:
+            error('cannot use manifest: {}'.format(e))
+            return 1
+    if args.database:
+        try:
+            args.database = open_database_sink(args.database, args.db_format)
+        except ValueError as e:
+            error('cannot write database: {}'.format(e))
+            return 1
+    if args.jsonl:
+        args.jsonl = JsonlSink(args.jsonl)
+    if args.archive:
+        try:
+            args.archive = ArchiveSink(args.archive, args.shard_size*2**20)
+        except ValueError as e:
+            error('cannot write archive: {}'.format(e))
+            return 1
+    set_norm_cache_size(args.cache_size)
+    if args.cache_file:
+        load_norm_caches(args.cache_file, sources)
+    if args.changes:
+        args.changes = open(args.changes, 'w', encoding='utf-8')
+    args.dir_sink, args.writer = None, None
+    if args.directory:
+        args.dir_sink = DirectorySink(args.directory, args.dir_prefix)
+    if args.workers is not None and args.workers > 1:
+        # Workers get copies of the caches loaded above
+        count = process_parallel(args.docs, args.tags, entitydb, namedb,
+                                 resolution, args)
+    else:
+        if args.directory:
+            args.writer = open_writer(args)
+        count = process(args.docs, args.tags, args)
+        if args.cache_file:
+            save_norm_caches(args.cache_file, sources)
     return 0
 
 
@@ -0,0 +1,179 @@
+# Join documents with tags that are not in document order.
+
+import os
+import heapq
+import hashlib
+import tempfile
+
+from collections import defaultdict
+from itertools import chain
+from logging import info, warning
+
+from common import Document, Mention, MentionBatch, Batch, skippable_line
+from common import DEFAULT_BATCH_SIZE, MAX_EXTRA_LINES
+from extsort import ExternalSorter, LINE_OVERHEAD
+from docindex import TsvIndex
+
+
+DEFAULT_MEMORY = 2**30
+
+
+def line_pmid(line):
+    return line.split('\t', 1)[0]
+
+
+def pmid_key(pmid):
+    """Return 63-bit integer key for PMID string (bytes) for TsvIndex,
+    which only indexes integers."""
+    digest = hashlib.blake2b(pmid, digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+def tag_pmid_key(line):
+    return pmid_key(line.split(b'\t', 1)[0])
+
+
+def report_extra(lines, count, fn):
+    """Warn about (line number, line) pairs of tags for no document."""
+    for ln, line in lines:
+        warning('extra line {} in {}: {}'.format(ln, fn, line.rstrip('\n')))
+    if count > len(lines):
+        warning('{} extra lines, ignoring rest'.format(count))
+
+
+class HashJoin(object):
+    """Tag lines grouped by PMID in memory."""
+
+    def __init__(self):
+        self.lines = defaultdict(list)    # PMID to (line number, line)
+
+    def add(self, ln, line):
+        self.lines[line_pmid(line)].append((ln, line))
+
+    def pop(self, pmid):
+        return self.lines.pop(pmid, [])
+
+    def all_lines(self):
+        for lines in self.lines.values():
+            yield from lines
+
+    def drain(self):
+        """Remove and iterate over all lines."""
+        while self.lines:
+            yield from self.lines.popitem()[1]
+
+    def report_unmatched(self, fn):
+        count = sum(len(lines) for lines in self.lines.values())
+        report_extra(heapq.nsmallest(MAX_EXTRA_LINES, self.all_lines()),
+                     count, fn)
+
+    def close(self):
+        self.lines = defaultdict(list)
+
+
+class SortJoin(object):
+    """Tag lines sorted by PMID on disk and indexed by PMID.
+
+    PMIDs are matched as strings, as in HashJoin. The index is keyed by
+    a hash of the PMID, and lines of other PMIDs with the same hash are
+    dropped on lookup.
+    """
+
+    def __init__(self, lines, memory, tmpdir=None):
+        fd, self.fn = tempfile.mkstemp(suffix='.tsv', dir=tmpdir)
+        self.total, self.matched = 0, 0
+        # Sort with line numbers added as an extra last field
+        with ExternalSorter(line_pmid, memory, tmpdir) as sorter:
+            for ln, line in lines:
+                sorter.add('{}\t{}\n'.format(line.rstrip('\n'), ln))
+                self.total += 1
+            info('merging {} sorted runs of tags'.format(sorter.spilled+1))
+            with open(fd, 'w', encoding='utf-8') as out:
+                out.writelines(sorter)
+        self.index = TsvIndex(self.fn, tag_pmid_key)
+        self.popped = set()
+
+    def pop(self, pmid):
+        if pmid is None or pmid in self.popped:
+            return []    # as HashJoin, tags go to the first document only
+        self.popped.add(pmid)
+        lines = []
+        for _, line in self.index.read_lines(pmid_key(pmid.encode('utf-8'))):
+            if line_pmid(line) != pmid:
+                continue    # hash collision
+            line, ln = line.rstrip('\n').rsplit('\t', 1)
+            lines.append((int(ln), line))
+        self.matched += len(lines)
+        return lines
+
+    def report_unmatched(self, fn):
+        if self.total > self.matched:
+            warning('{} extra lines in {}'.format(self.total-self.matched, fn))
+
+    def close(self):
+        self.index.close()
+        for fn in (self.fn, self.index.idxfn):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+def tag_lines(tags):
+    """Iterate (line number, line) of tags, skipping comments and empty."""
+    for ln, line in enumerate(tags, start=1):
+        if skippable_line(line):
+            warning('skipping line {} in {}: {}'.format(
+                ln, tags.name, line.rstrip('\n')))
+        else:
+            yield ln, line
+
+
+def load_tags(tags, memory, tmpdir=None):
+    """Return HashJoin for tags if within memory budget, else SortJoin."""
+    join, size = HashJoin(), 0
+    lines = tag_lines(tags)
+    for ln, line in lines:
+        join.add(ln, line)
+        size += len(line) + LINE_OVERHEAD
+        if size > memory:
+            info('tags in {} exceed memory budget, sorting on disk'.format(
+                tags.name))
+            return SortJoin(chain(join.drain(), lines), memory, tmpdir)
+    return join
+
+
+def read_batches_unordered(docs, tags, batch_size=DEFAULT_BATCH_SIZE,
+                           limit=None, memory=DEFAULT_MEMORY, tmpdir=None):
+    """Read docs and tags streams with tags in any order.
+
+    As common.read_batches(), but the tags are first grouped by PMID,
+    in memory (hash join) if their approximate size is within memory
+    bytes and otherwise with an external merge sort by PMID into a
+    temporary file indexed with docindex.TsvIndex. Documents are
+    yielded in docs order.
+    """
+    join = load_tags(tags, memory, tmpdir)
+    try:
+        batch, total = Batch(), 0
+        for doc_ln, doc_line in enumerate(docs, start=1):
+            if limit is not None and total >= limit:
+                break
+            document = Document.from_tsv(doc_line, doc_ln, docs.name)
+            rows = []
+            for ln, line in join.pop(document.pmid):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 8:
+                    Mention.from_fields(fields, ln, tags.name)    # raises
+                rows.append(fields)
+            mentions = MentionBatch.from_fields(rows)
+            mentions.validate_text(document.text)
+            batch.append((document, mentions))
+            total += 1
+            if len(batch) >= batch_size:
+                yield batch
+                batch = Batch()
+        if batch:
+            yield batch
+        if limit is None or total < limit:
+            join.report_unmatched(tags.name)
+    finally:
+        join.close()